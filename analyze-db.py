@@ -1,8 +1,20 @@
 import csv
+import io
 import yaml
 import re
+import os
+import json
+import pickle
+import hashlib
+import sys
+import argparse
+from functools import partial
 from tqdm import tqdm
-import pyisbn
+from identifiers import normalize_from_db, well_formed, looksgood, equivalence_key, canonical_isbn
+from db_stream import iter_works
+from scan_store import ScanStore
+from parallel import map_partitions, check_parallel
+import catalog
 
 # use yaml.CSafeLoader / if available but don't crash if it isn't
 try:
@@ -15,45 +27,17 @@ try:
 except (ImportError, AttributeError):
     yaml_dumper = yaml.SafeDumper
 
-def normalize_isbn(isbn):
-    return isbn.upper().replace("-", "").replace(" ", "")
-
-def well_formed(isbn):
-    # assumes isbn is normalized
-    match = re.search(r'^(\d{9}[0-9X]|\d{13})$', isbn)
-    return True if match else False
-
-def valid(isbn):
-    # assumes isbn is normalized
-    match = re.search(r'^(\d{9}|\d{12})(\d|X)$', isbn)
-    if not match:
-        return False
-
-    digits = match.group(1)
-    check_digit = 10 if match.group(2) == 'X' else int(match.group(2))
-    result = sum((i + 1) * int(digit) for i, digit in enumerate(digits))
-    if len(isbn) == 10:
-        return (result % 11) == check_digit
-    else:
-        return (result % 10) == check_digit
-
-def looksgood(isbn):
-    if not well_formed(isbn):
-        return False
-    if not isbn.startswith("978") and not isbn.startswith("979"):
-        return False
-    return pyisbn.validate(isbn)
-
-def addqm(isbn):
-    if looksgood(isbn):
+def addqm(isbn, isbns):
+    # isbns are the entries of IsbnIndex.get_entries()
+    if isbns[isbn]["looksgood"]:
         return isbn
     else:
         return isbn+"?"
 
-def join_addqm(isbn_list):
+def join_addqm(isbn_list, isbns):
     new_list = []
     for isbn in isbn_list:
-        new_list.append(addqm(isbn))
+        new_list.append(addqm(isbn, isbns))
     return ", ".join(new_list)
 
 def equivalent(isbn1, isbn2):
@@ -65,55 +49,88 @@ def equivalent(isbn1, isbn2):
         return isbn1 == isbn2
     if len(isbn1) not in [10, 13] or len(isbn2) not in [10, 13]:
         return isbn1 == isbn2
-    if len(isbn1) == 10:
-        return isbn1[:9] == isbn2[3:12]
-    else:
-        return isbn1[3:12] == isbn2[:9]
+    return equivalence_key(isbn1) == equivalence_key(isbn2)
 
-def has_equivalent_in(isbn, isbn_list):
-    if not isbn_list:
-        return False
-    for isbn_i in isbn_list:
-        if equivalent(isbn_i, isbn):
+class EquivalenceSet:
+    """
+    set of isbns where has_equivalent() is a lookup instead of a scan of the list
+    """
+
+    def __init__(self, isbn_list=None):
+        self.isbns = set()
+        # (len, equivalence key)
+        self.keys = set()
+        for isbn in isbn_list or []:
+            self.add(isbn)
+
+    def add(self, isbn):
+        self.isbns.add(isbn)
+        key = equivalence_key(isbn)
+        if key is not None:
+            self.keys.add((len(isbn), key))
+
+    def has_equivalent(self, isbn):
+        if isbn in self.isbns:
             return True
-    return False
+        key = equivalence_key(isbn)
+        if key is None:
+            return False
+        return (13 if len(isbn) == 10 else 10, key) in self.keys
+
+class IsbnIndex:
+    """
+    isbns of the catalog and of the scans. Each isbn string is converted once
+    to its canonical 13 digits key (see canonical_isbn) with its validity
+    flags, and each key points to the forms, mws and images (w, ig, imgfname)
+    where it appears, so that the isbn-10 and isbn-13 forms of an isbn are
+    found by a single lookup.
+    """
+
+    def __init__(self):
+        # isbn -> {"key", "well_formed", "looksgood"}
+        self.isbns = {}
+        # key -> {"well_formed", "forms": set, "mws": set, "images": set}
+        self.keys = {}
+
+    def add(self, isbn, mw, image=None):
+        entry = self.isbns.get(isbn)
+        if entry is None:
+            entry = {"key": canonical_isbn(isbn), "well_formed": well_formed(isbn), "looksgood": looksgood(isbn)}
+            self.isbns[isbn] = entry
+        key_info = self.keys.get(entry["key"])
+        if key_info is None:
+            key_info = {"well_formed": entry["well_formed"], "forms": set(), "mws": set(), "images": set()}
+            self.keys[entry["key"]] = key_info
+        key_info["forms"].add(isbn)
+        key_info["mws"].add(mw)
+        if image is not None:
+            key_info["images"].add(image)
 
-def normalize_from_db(isbn):
-    if '(' in isbn:
-        isbn = isbn[:isbn.find('(')]
-    if '/' in isbn:
-        isbn = isbn[:isbn.find('/')]
-    return normalize_isbn(isbn)
+    def get_entries(self, mw_info):
+        # entries of the isbns of a mw, sent with it to the classification
+        return {isbn: self.isbns[isbn] for isbn in mw_info["from_db"] + mw_info["from_scans"]}
 
 def get_mw_infos(data):
     # todo: handle cases like "8189165275, 9788189165277" which are isbn10, isbn13 of same isbn
-    with open('mw-isbn.csv', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            mw = row[0]
-            orig_isbn_str = row[1]
-            orig_isbns = re.split(',|;', orig_isbn_str)
-            for orig_isbn in orig_isbns:
-                normalized_isbn = normalize_from_db(orig_isbn)
-                #if not well_formed(normalized_isbn):
-                #    print("ignore from db: mw: "+mw+", isbn: "+normalized_isbn)
-                #    continue
-                if normalized_isbn not in data["isbn_info"]:
-                    data["isbn_info"][normalized_isbn] = {}
-                if mw not in data["isbn_info"][normalized_isbn]:
-                    data["isbn_info"][normalized_isbn][mw] = {}
-                data["isbn_info"][normalized_isbn][mw]["from_db"] = True
-                if mw not in data["mw_info"]:
-                    data["mw_info"][mw] = {"from_db": [], "from_scans": [], "from_scans": [], "per_ig": {}, "ig_to_vnum": {}}
-                data["mw_info"][mw]["from_db"].append(normalized_isbn)
+    for mw, orig_isbn_str in catalog.load_catalog().iter_isbn_rows():
+        orig_isbns = re.split(',|;', orig_isbn_str)
+        for orig_isbn in orig_isbns:
+            normalized_isbn = normalize_from_db(orig_isbn)
+            #if not well_formed(normalized_isbn):
+            #    print("ignore from db: mw: "+mw+", isbn: "+normalized_isbn)
+            #    continue
+            if normalized_isbn not in data["isbn_info"]:
+                data["isbn_info"][normalized_isbn] = {}
+            if mw not in data["isbn_info"][normalized_isbn]:
+                data["isbn_info"][normalized_isbn][mw] = {}
+            data["isbn_info"][normalized_isbn][mw]["from_db"] = True
+            if mw not in data["mw_info"]:
+                data["mw_info"][mw] = {"from_db": [], "from_scans": [], "from_scans": [], "per_ig": {}, "ig_to_vnum": {}}
+            data["mw_info"][mw]["from_db"].append(normalized_isbn)
+            data["isbn_index"].add(normalized_isbn, mw)
 
 def get_w_to_mw():
-    res = {}
-    with open('mw-w-ig-vn.csv', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            res[row[1]] = row[0]
-    return res
+    return catalog.get_w_to_mw()
 
 # data["isbn_info"]
 #   isbn:
@@ -159,6 +176,7 @@ def analyze_w(w, w_dbinfo, mw, data, stats):
             if ig not in data["isbn_info"][isbn][mw][w]:
                 data["isbn_info"][isbn][mw][w][ig] = []
             data["isbn_info"][isbn][mw][w][ig].append(imgfname)
+            data["found"].append((isbn, w, ig, imgfname))
             if mw not in data["mw_info"]:
                 data["mw_info"][mw] = {"from_db": [], "from_scans": [], "per_ig": {}, "ig_to_vnum": {}}
             data["mw_info"][mw]["from_scans"].append(isbn)
@@ -168,103 +186,115 @@ def analyze_w(w, w_dbinfo, mw, data, stats):
                 data["mw_info"][mw]["per_ig"][ig].append(isbn)
 
 def handle_duplicates(data, stats):
-    for isbn, isbn_data in data["isbn_info"].items():
-        mws = isbn_data.keys()
-        if len(mws) > 1:
-            print(isbn+" present in multiple instances: "+", ".join(mws))
+    # well formed isbns of the catalog or of the scans of several mws, in any of their forms
+    for key, key_info in sorted(data["isbn_index"].keys.items()):
+        if key_info["well_formed"] and len(key_info["mws"]) > 1:
+            data["isbn_used_multiple_times"].append([key, ", ".join(sorted(key_info["forms"])), ", ".join(sorted(key_info["mws"]))])
             stats["isbn_used_multiple_times"] += 1
 
 def handle_differences(data, stats):
     for mw, mw_data in data["mw_info"].items():
-        from_db_not_in_scans = set(mw_data["from_db"]) - set(mw_data["from_scans"])
-        stats["in_db_not_in_scans"] += len(from_db_not_in_scans)
-        from_scans_not_in_db = set(mw_data["from_scans"]) - set(mw_data["from_db"])
-        stats["in_scans_not_in_db"] += len(from_scans_not_in_db)
-        #if from_db_not_in_scans and from_scans_not_in_db:
-        #    print(mw+" has isbns in db not in scans: "+", ".join(from_db_not_in_scans)+" and isbns in scans not in db: "+", ".join(from_scans_not_in_db))
-        #elif from_db_not_in_scans:
-        #    print(mw+" has isbns in db not in scans: "+", ".join(from_db_not_in_scans))
-        #elif from_scans_not_in_db:
-        #    print(mw+" has isbns in scans not in db: "+", ".join(from_scans_not_in_db))
-        if len(mw_data["from_db"]) == 1 and len(mw_data["from_scans"]) == 1:
-            if not well_formed(mw_data["from_db"][0]):
-                data["proposed_substitutions_malformed"].append([mw, mw_data["from_db"][0], addqm(mw_data["from_scans"][0])])
-            elif mw_data["from_db"][0] != mw_data["from_scans"][0]:
-                if equivalent(mw_data["from_db"][0], mw_data["from_scans"][0]):
-                    data["new_isbns"].append([mw, addqm(mw_data["from_scans"][0]), mw_data["from_db"][0], ""])
-                else:
-                    data["proposed_substitutions"].append([mw, mw_data["from_db"][0], addqm(mw_data["from_scans"][0])])
-        if len(mw_data["from_db"]) == 1 and len(mw_data["from_scans"]) == 0 and not well_formed(mw_data["from_db"][0]):
-            data["malformed_to_review"].append([mw, mw_data["from_db"][0]])
-        if len(mw_data["from_db"]) == 0 and len(mw_data["from_scans"]) == 1:
-            data["new_isbns"].append([mw, addqm(mw_data["from_scans"][0]), "", ""])
+        classify_differences(mw, mw_data, data["isbn_index"].get_entries(mw_data), data, stats)
+
+def classify_differences(mw, mw_data, isbns, data, stats):
+    from_db_not_in_scans = set(mw_data["from_db"]) - set(mw_data["from_scans"])
+    stats["in_db_not_in_scans"] += len(from_db_not_in_scans)
+    from_scans_not_in_db = set(mw_data["from_scans"]) - set(mw_data["from_db"])
+    stats["in_scans_not_in_db"] += len(from_scans_not_in_db)
+    #if from_db_not_in_scans and from_scans_not_in_db:
+    #    print(mw+" has isbns in db not in scans: "+", ".join(from_db_not_in_scans)+" and isbns in scans not in db: "+", ".join(from_scans_not_in_db))
+    #elif from_db_not_in_scans:
+    #    print(mw+" has isbns in db not in scans: "+", ".join(from_db_not_in_scans))
+    #elif from_scans_not_in_db:
+    #    print(mw+" has isbns in scans not in db: "+", ".join(from_scans_not_in_db))
+    if len(mw_data["from_db"]) == 1 and len(mw_data["from_scans"]) == 1:
+        if not isbns[mw_data["from_db"][0]]["well_formed"]:
+            data["proposed_substitutions_malformed"].append([mw, mw_data["from_db"][0], addqm(mw_data["from_scans"][0], isbns)])
+        elif mw_data["from_db"][0] != mw_data["from_scans"][0]:
+            if equivalent(mw_data["from_db"][0], mw_data["from_scans"][0]):
+                data["new_isbns"].append([mw, addqm(mw_data["from_scans"][0], isbns), mw_data["from_db"][0], ""])
+            else:
+                data["proposed_substitutions"].append([mw, mw_data["from_db"][0], addqm(mw_data["from_scans"][0], isbns)])
+    if len(mw_data["from_db"]) == 1 and len(mw_data["from_scans"]) == 0 and not isbns[mw_data["from_db"][0]]["well_formed"]:
+        data["malformed_to_review"].append([mw, mw_data["from_db"][0]])
+    if len(mw_data["from_db"]) == 0 and len(mw_data["from_scans"]) == 1:
+        data["new_isbns"].append([mw, addqm(mw_data["from_scans"][0], isbns), "", ""])
 
 
 def handle_multivolumes(data, stats):
     for mw, mwinfo in data["mw_info"].items():
-        if len(mwinfo["ig_to_vnum"]) < 2 or len(mwinfo["per_ig"]) == 0:
-            continue
-        ordered_igs = sorted(mwinfo["ig_to_vnum"].keys(), key=lambda x: mwinfo["ig_to_vnum"][x])
-        all_isbns = []
-        for ig, isbn_list in mwinfo["per_ig"].items():
-            for isbn in isbn_list:
-                if isbn in all_isbns:
-                    continue
-                all_isbns.append(isbn)
-        if len(mwinfo["ig_to_vnum"]) == len(mwinfo["per_ig"]):
-            stats["found_all_volumes"] += 1
-            stats["nb_volumes_found_after_first"] += len(mwinfo["per_ig"])
-            if len(all_isbns) == 1:
-                if len(mwinfo["from_db"]) == 0:
-                    data["new_isbns"].append([mw, isbn_list[0], "", "found on all "+str(len(mwinfo["per_ig"]))+" volumes"])
-                elif len(mwinfo["from_db"]) == 1:
-                    if mwinfo["from_db"][0] != isbn_list[0]:
-                        if equivalent(mwinfo["from_db"][0], isbn_list[0]):
-                            data["new_isbns"].append([mw, addqm(isbn_list[0]), mwinfo["from_db"][0], "found on all "+str(len(mwinfo["per_ig"]))+" volumes"])
-                        else:
-                            data["proposed_substitutions"].append([mw, mwinfo["from_db"][0], addqm(mwinfo["from_scans"][0]), "found on all "+str(len(mwinfo["per_ig"]))+" volumes"])
-                else:
-                    data["proposed_substitutions"].append([mw, mwinfo["from_db"][0], addqm(mwinfo["from_scans"][0]), "found on all "+str(len(mwinfo["per_ig"]))+" volumes"])
+        classify_multivolume(mw, mwinfo, data["isbn_index"].get_entries(mwinfo), data, stats)
+
+def classify_multivolume(mw, mwinfo, isbns, data, stats):
+    if len(mwinfo["ig_to_vnum"]) < 2 or len(mwinfo["per_ig"]) == 0:
+        return
+    ordered_igs = sorted(mwinfo["ig_to_vnum"].keys(), key=lambda x: mwinfo["ig_to_vnum"][x])
+    all_isbns = []
+    # same isbns, for the equivalence lookups
+    all_isbns_set = EquivalenceSet()
+    for ig, isbn_list in mwinfo["per_ig"].items():
+        for isbn in isbn_list:
+            if isbn in all_isbns_set.isbns:
+                continue
+            all_isbns_set.add(isbn)
+            all_isbns.append(isbn)
+    if len(mwinfo["ig_to_vnum"]) == len(mwinfo["per_ig"]):
+        stats["found_all_volumes"] += 1
+        stats["nb_volumes_found_after_first"] += len(mwinfo["per_ig"])
+        if len(all_isbns) == 1:
+            if len(mwinfo["from_db"]) == 0:
+                data["new_isbns"].append([mw, isbn_list[0], "", "found on all "+str(len(mwinfo["per_ig"]))+" volumes"])
+            elif len(mwinfo["from_db"]) == 1:
+                if mwinfo["from_db"][0] != isbn_list[0]:
+                    if equivalent(mwinfo["from_db"][0], isbn_list[0]):
+                        data["new_isbns"].append([mw, addqm(isbn_list[0], isbns), mwinfo["from_db"][0], "found on all "+str(len(mwinfo["per_ig"]))+" volumes"])
+                    else:
+                        data["proposed_substitutions"].append([mw, mwinfo["from_db"][0], addqm(mwinfo["from_scans"][0], isbns), "found on all "+str(len(mwinfo["per_ig"]))+" volumes"])
             else:
-                if len(mwinfo["from_db"]) == 0 or (len(mwinfo["from_db"]) == 1 and has_equivalent_in(mwinfo["from_db"][0], all_isbns)):
-                    data["mutli_volumes_diff_isbn_no_review"][mw] = []
-                    for ig in ordered_igs:
-                        data["mutli_volumes_diff_isbn_no_review"][mw].append([mwinfo["ig_to_vnum"][ig], join_addqm(mwinfo["per_ig"][ig])])
-                else:
-                    data["mutli_volumes_diff_isbn_review"][mw] = []
-                    for ig in ordered_igs:
-                        data["mutli_volumes_diff_isbn_review"][mw].append([mwinfo["ig_to_vnum"][ig], ", ".join(mwinfo["from_db"]), join_addqm(mwinfo["per_ig"][ig])])
+                data["proposed_substitutions"].append([mw, mwinfo["from_db"][0], addqm(mwinfo["from_scans"][0], isbns), "found on all "+str(len(mwinfo["per_ig"]))+" volumes"])
         else:
-            stats["found_not_all_volumes"] += 1
-            stats["nb_volumes_found_after_first"] += len(mwinfo["per_ig"])
-            stats["nb_volumes_not_found_after_first"] += len(mwinfo["ig_to_vnum"]) - len(mwinfo["per_ig"])
-            volumesfound = []
-            for ig in mwinfo["per_ig"]:
-                volumesfound.append(mwinfo["ig_to_vnum"][ig])
-            volumesfound = sorted(volumesfound)
-            volumesfound = [str(x) for x in volumesfound]
-            if len(all_isbns) == 1 and len(mwinfo["per_ig"]) > 1:
-                if len(mwinfo["from_db"]) == 0:
-                    data["new_isbns"].append([mw, isbn_list[0], "", "found on "+str(len(mwinfo["per_ig"]))+"/"+str(len(mwinfo["ig_to_vnum"]))+" volumes"])
-                elif len(mwinfo["from_db"]) == 1:
-                    if mwinfo["from_db"][0] != isbn_list[0]:
-                        if equivalent(mwinfo["from_db"][0], isbn_list[0]):
-                            data["new_isbns"].append([mw, addqm(isbn_list[0]), mwinfo["from_db"][0], "found on volumes "+", ".join(volumesfound)+" (no other isbn found)"])
-                        else:
-                            data["proposed_substitutions"].append([mw, mwinfo["from_db"][0], addqm(mwinfo["from_scans"][0]), "found on volumes "+", ".join(volumesfound)+" (no other isbn found)"])
-                else:
-                    data["proposed_substitutions"].append([mw, mwinfo["from_db"][0], mwinfo["from_scans"][0], "found on volumes "+", ".join(volumesfound)+" (no other isbn found)"])
+            if len(mwinfo["from_db"]) == 0 or (len(mwinfo["from_db"]) == 1 and all_isbns_set.has_equivalent(mwinfo["from_db"][0])):
+                data["mutli_volumes_diff_isbn_no_review"][mw] = []
+                for ig in ordered_igs:
+                    data["mutli_volumes_diff_isbn_no_review"][mw].append([mwinfo["ig_to_vnum"][ig], join_addqm(mwinfo["per_ig"][ig], isbns)])
             else:
                 data["mutli_volumes_diff_isbn_review"][mw] = []
                 for ig in ordered_igs:
-                    data["mutli_volumes_diff_isbn_review"][mw].append([mwinfo["ig_to_vnum"][ig], ", ".join(mwinfo["from_db"]), join_addqm(mwinfo["per_ig"][ig]) if ig in mwinfo["per_ig"] else "?"])
+                    data["mutli_volumes_diff_isbn_review"][mw].append([mwinfo["ig_to_vnum"][ig], ", ".join(mwinfo["from_db"]), join_addqm(mwinfo["per_ig"][ig], isbns)])
+    else:
+        stats["found_not_all_volumes"] += 1
+        stats["nb_volumes_found_after_first"] += len(mwinfo["per_ig"])
+        stats["nb_volumes_not_found_after_first"] += len(mwinfo["ig_to_vnum"]) - len(mwinfo["per_ig"])
+        volumesfound = []
+        for ig in mwinfo["per_ig"]:
+            volumesfound.append(mwinfo["ig_to_vnum"][ig])
+        volumesfound = sorted(volumesfound)
+        volumesfound = [str(x) for x in volumesfound]
+        if len(all_isbns) == 1 and len(mwinfo["per_ig"]) > 1:
+            if len(mwinfo["from_db"]) == 0:
+                data["new_isbns"].append([mw, isbn_list[0], "", "found on "+str(len(mwinfo["per_ig"]))+"/"+str(len(mwinfo["ig_to_vnum"]))+" volumes"])
+            elif len(mwinfo["from_db"]) == 1:
+                if mwinfo["from_db"][0] != isbn_list[0]:
+                    if equivalent(mwinfo["from_db"][0], isbn_list[0]):
+                        data["new_isbns"].append([mw, addqm(isbn_list[0], isbns), mwinfo["from_db"][0], "found on volumes "+", ".join(volumesfound)+" (no other isbn found)"])
+                    else:
+                        data["proposed_substitutions"].append([mw, mwinfo["from_db"][0], addqm(mwinfo["from_scans"][0], isbns), "found on volumes "+", ".join(volumesfound)+" (no other isbn found)"])
+            else:
+                data["proposed_substitutions"].append([mw, mwinfo["from_db"][0], mwinfo["from_scans"][0], "found on volumes "+", ".join(volumesfound)+" (no other isbn found)"])
+        else:
+            data["mutli_volumes_diff_isbn_review"][mw] = []
+            for ig in ordered_igs:
+                data["mutli_volumes_diff_isbn_review"][mw].append([mwinfo["ig_to_vnum"][ig], ", ".join(mwinfo["from_db"]), join_addqm(mwinfo["per_ig"][ig], isbns) if ig in mwinfo["per_ig"] else "?"])
 
-def main():
-    db = None
-    with open("db.yml", 'r') as stream:
-        db = yaml.load(stream, Loader=yaml_loader)
-    w_to_mw = get_w_to_mw()
-    stats = {
+# outputs of the classification of a mw, lists of rows and mw -> rows
+LIST_OUTPUTS = ["proposed_substitutions", "proposed_substitutions_malformed", "malformed_to_review", "new_isbns"]
+MV_OUTPUTS = ["mutli_volumes_diff_isbn_no_review", "mutli_volumes_diff_isbn_review"]
+
+# 2: the isbns found are the (isbn, image) pairs of analyze_w
+STATE_VERSION = 2
+
+def new_stats():
+    return {
         "total": 0,
         "same_as_db": 0,
         "different_from_db": 0,
@@ -278,63 +308,254 @@ def main():
         "nb_volumes_found_after_first": 0,
         "nb_volumes_not_found_after_first": 0,
     }
+
+def new_data():
     data = {
         "new": {},
         "check_different": {},
         "same_isbn": {},
         "isbn_info": {},
-        "mw_info": {},
-        "proposed_substitutions": [],
-        "proposed_substitutions_malformed": [],
-        "malformed_to_review": [],
-        "new_isbns": [],
-        "mutli_volumes_diff_isbn_no_review": {},
-        "mutli_volumes_diff_isbn_review": {}
+        # (isbn, w, ig, imgfname) for each image where an isbn was found
+        "found": [],
+        "isbn_index": IsbnIndex(),
+        "isbn_used_multiple_times": [],
+        "mw_info": {}
     }
-    get_mw_infos(data)
-    for w in tqdm(db):
-        w_dbinfo = db[w]
+    for name in LIST_OUTPUTS:
+        data[name] = []
+    for name in MV_OUTPUTS:
+        data[name] = {}
+    return data
+
+def fingerprint(obj):
+    return hashlib.sha1(json.dumps(obj).encode('utf-8')).hexdigest()
+
+def iter_w_sources(path):
+    """
+    yields (w, fingerprint, function returning w_dbinfo) for each work of the db.
+    With a sqlite store the fingerprints are computed on the raw rows and the
+    works are only read when their contribution has to be computed again.
+    """
+    if path.endswith(".sqlite"):
+        store = ScanStore(path)
+        for w, fp in store.get_fingerprints():
+            yield w, fp, lambda w=w: store.get_w(w)
+        store.close()
+        return
+    for w, w_dbinfo in iter_works(path):
+        yield w, fingerprint(w_dbinfo), lambda w_dbinfo=w_dbinfo: w_dbinfo
+
+def get_contribution(w, w_dbinfo, mw):
+    """
+    what analyze_w adds to the data for a work: its part of mw_info[mw] (None
+    if it adds nothing) and the isbns found, as (isbn, w, ig, imgfname)
+    """
+    data = new_data()
+    analyze_w(w, w_dbinfo, mw, data, new_stats())
+    return data["mw_info"].get(mw), sorted(data["found"])
+
+# store of the worker process, when the works are read from a sqlite store
+WORKER_STORE = None
+
+def analyze_partition(db_path, partition):
+    """
+    contributions of a partition of (w, w_fp, mw, w_dbinfo, analyze), None for the
+    works that don't need to be analyzed. w_dbinfo is None when the worker
+    has to read the work from the sqlite store at db_path.
+    """
+    global WORKER_STORE
+    res = []
+    for w, _, mw, w_dbinfo, analyze in partition:
+        if not analyze:
+            res.append(None)
+            continue
+        if w_dbinfo is None:
+            if WORKER_STORE is None:
+                WORKER_STORE = ScanStore(db_path)
+            w_dbinfo = WORKER_STORE.get_w(w)
+        res.append(get_contribution(w, w_dbinfo, mw))
+    return res
+
+def merge_contribution(data, mw, contribution):
+    # same as analyze_w, from the result of get_contribution
+    mw_contribution, found = contribution
+    for isbn, w, ig, imgfname in found:
+        if isbn not in data["isbn_info"]:
+            data["isbn_info"][isbn] = {}
+        data["isbn_index"].add(isbn, mw, (w, ig, imgfname))
+    if mw_contribution is None:
+        return
+    if mw not in data["mw_info"]:
+        data["mw_info"][mw] = {"from_db": [], "from_scans": [], "per_ig": {}, "ig_to_vnum": {}}
+    mw_info = data["mw_info"][mw]
+    mw_info["ig_to_vnum"].update(mw_contribution["ig_to_vnum"])
+    mw_info["from_scans"].extend(mw_contribution["from_scans"])
+    for ig, isbns in mw_contribution["per_ig"].items():
+        if ig not in mw_info["per_ig"]:
+            mw_info["per_ig"][ig] = []
+        for isbn in isbns:
+            if isbn not in mw_info["per_ig"][ig]:
+                mw_info["per_ig"][ig].append(isbn)
+
+def classify_mw(mw, mw_info, isbns):
+    """
+    rows and stats that handle_differences and handle_multivolumes produce for a mw,
+    as {"diff": (outputs, stats), "mv": (outputs, stats)}, isbns are the entries
+    of the isbns of the mw in the IsbnIndex
+    """
+    res = {}
+    for step, classify in [("diff", classify_differences), ("mv", classify_multivolume)]:
+        data = new_data()
+        stats = new_stats()
+        classify(mw, mw_info, isbns, data, stats)
+        outputs = {name: data[name] for name in LIST_OUTPUTS + MV_OUTPUTS if data[name]}
+        res[step] = (outputs, {k: v for k, v in stats.items() if v})
+    return res
+
+def classify_partition(partition):
+    return [classify_mw(mw, mw_info, isbns) for mw, mw_info, isbns in partition]
+
+def load_state(path):
+    if path is None or not os.path.isfile(path):
+        return {"version": STATE_VERSION, "ws": {}, "mws": {}}
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if state.get("version") != STATE_VERSION:
+        return {"version": STATE_VERSION, "ws": {}, "mws": {}}
+    return state
+
+def save_state(state, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmppath = path+".tmp"
+    with open(tmppath, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmppath, path)
+
+def write_csv(path, rows):
+    # the file is only rewritten when its content changes
+    f = io.StringIO(newline='')
+    writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+    for row in rows:
+        writer.writerow(row)
+    content = f.getvalue()
+    if os.path.isfile(path):
+        with open(path, newline='') as csvfile:
+            if csvfile.read() == content:
+                return False
+    with open(path, 'w', newline='') as csvfile:
+        csvfile.write(content)
+    return True
+
+def mv_rows(mv_output):
+    rows = []
+    for mw in sorted(mv_output.keys()):
+        for e in mv_output[mw]:
+            rows.append([mw]+ e)
+        rows.append([])
+    return rows
+def iter_w_jobs(db_path, w_to_mw, state, read_in_worker):
+    # (w, w_fp, mw, w_dbinfo, analyze) for each work of the db that has a mw
+    for w, w_fp, get_w_dbinfo in tqdm(iter_w_sources(db_path)):
         if w not in w_to_mw:
             # weird case where some spurious ws are in the db with no data
             continue
         mw = w_to_mw[w]
-        analyze_w(w, w_dbinfo, mw, data, stats)
-    # handle_duplicates(data, stats)
-    handle_differences(data, stats)
-    handle_multivolumes(data, stats)
+        previous = state["ws"].get(w)
+        if previous is not None and previous[0] == w_fp and previous[1] == mw:
+            yield w, w_fp, mw, None, False
+        else:
+            yield w, w_fp, mw, None if read_in_worker else get_w_dbinfo(), True
+
+def main(db_path="db.yml", state_path=None, nb_workers=1, out_dir="analysis"):
+    """
+    state_path is the file where the fingerprints of the works and mws and their
+    results are kept between runs (incremental mode): only the works whose scans
+    changed are analyzed again, and only the mws whose inputs (isbns of the catalog
+    and of the scans) changed are classified again.
+
+    With nb_workers > 1 the works are analyzed and the mws classified in worker
+    processes (map), and the results are merged in the order of the db (reduce),
+    which gives the same outputs as the serial run.
+    """
+    w_to_mw = get_w_to_mw()
+    stats = new_stats()
+    data = new_data()
+    state = load_state(state_path)
+    new_state = {"version": STATE_VERSION, "ws": {}, "mws": {}}
+    get_mw_infos(data)
+    nb_ws_analyzed = 0
+    # with a sqlite store the workers read the works themselves
+    read_in_worker = nb_workers > 1 and db_path.endswith(".sqlite")
+    jobs = iter_w_jobs(db_path, w_to_mw, state, read_in_worker)
+    for (w, w_fp, mw, _, analyze), contribution in map_partitions(partial(analyze_partition, db_path), jobs, nb_workers):
+        if analyze:
+            nb_ws_analyzed += 1
+        else:
+            contribution = state["ws"][w][2]
+        new_state["ws"][w] = (w_fp, mw, contribution)
+        merge_contribution(data, mw, contribution)
+    handle_duplicates(data, stats)
+    results = {}
+    to_classify = []
+    for mw, mw_info in data["mw_info"].items():
+        mw_fp = fingerprint(mw_info)
+        previous = state["mws"].get(mw)
+        if previous is not None and previous[0] == mw_fp:
+            results[mw] = previous[1]
+        else:
+            # keeps the order of data["mw_info"]
+            results[mw] = None
+            to_classify.append((mw, mw_info, data["isbn_index"].get_entries(mw_info)))
+        new_state["mws"][mw] = (mw_fp, results[mw])
+    for (mw, _, _), res in map_partitions(classify_partition, to_classify, nb_workers):
+        results[mw] = res
+        new_state["mws"][mw] = (new_state["mws"][mw][0], res)
+    nb_mws_classified = len(to_classify)
+    # same order as handle_differences then handle_multivolumes
+    for step in ["diff", "mv"]:
+        for mw, res in results.items():
+            outputs, mw_stats = res[step]
+            for name, rows in outputs.items():
+                if name in MV_OUTPUTS:
+                    data[name].update(rows)
+                else:
+                    data[name].extend(rows)
+            for k, v in mw_stats.items():
+                stats[k] += v
+    if state_path is not None:
+        save_state(new_state, state_path)
+        print("%d works analyzed, %d mws classified" % (nb_ws_analyzed, nb_mws_classified))
     data["proposed_substitutions_malformed"] = sorted(data["proposed_substitutions_malformed"], key=lambda x: x[0])
     data["proposed_substitutions"] = sorted(data["proposed_substitutions"], key=lambda x: x[0])
     data["malformed_to_review"] = sorted(data["malformed_to_review"], key=lambda x: x[0])
-    with open('analysis/simple_substitutions_malformed.csv', 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        for row in data["proposed_substitutions_malformed"]:
-            writer.writerow(row)
-    with open('analysis/simple_substitutions.csv', 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        for row in data["proposed_substitutions"]:
-            writer.writerow(row)
-    with open('analysis/malformed_toreview.csv', 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        for row in data["malformed_to_review"]:
-            writer.writerow(row)
-    with open('analysis/new_isbns.csv', 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        for row in data["new_isbns"]:
-            writer.writerow(row)
-    with open('analysis/mutli_volumes_diff_isbn_review.csv', 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        for mw in sorted(data["mutli_volumes_diff_isbn_review"].keys()):
-            for e in data["mutli_volumes_diff_isbn_review"][mw]:
-                writer.writerow([mw]+ e)
-            writer.writerow([])
-    with open('analysis/mutli_volumes_diff_isbn_no_review.csv', 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        for mw in sorted(data["mutli_volumes_diff_isbn_no_review"].keys()):
-            for e in data["mutli_volumes_diff_isbn_no_review"][mw]:
-                writer.writerow([mw]+ e)
-            writer.writerow([])
+    outputs = [
+        ('simple_substitutions_malformed.csv', data["proposed_substitutions_malformed"]),
+        ('simple_substitutions.csv', data["proposed_substitutions"]),
+        ('malformed_toreview.csv', data["malformed_to_review"]),
+        ('new_isbns.csv', data["new_isbns"]),
+        ('mutli_volumes_diff_isbn_review.csv', mv_rows(data["mutli_volumes_diff_isbn_review"])),
+        ('mutli_volumes_diff_isbn_no_review.csv', mv_rows(data["mutli_volumes_diff_isbn_no_review"])),
+        ('isbn_used_multiple_times.csv', data["isbn_used_multiple_times"])
+    ]
+    for fname, rows in outputs:
+        path = os.path.join(out_dir, fname)
+        if write_csv(path, rows):
+            print("updated "+path)
 
     stats["total"] = len(data["isbn_info"].keys())
     print(stats)
+    return stats
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compares the isbns found in the scans with the catalog, writes the results in analysis/")
+    parser.add_argument("--db", default="db.yml", help="db.yml or db.sqlite")
+    parser.add_argument("--incremental", action="store_true", help="only analyze the works and mws that changed since the previous incremental run (state in cache/analysis_state.pickle)")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="number of processes analyzing the works (1 = serial mode)")
+    parser.add_argument("--rdf-dump", help="read the catalog from this local RDF dump instead of mw-w-ig-vn.csv and mw-isbn.csv (requires pyoxigraph)")
+    parser.add_argument("--check-parallel", action="store_true", help="run the analysis serially and in parallel in temporary directories and check that the outputs are identical")
+    args = parser.parse_args()
+    if args.rdf_dump is not None:
+        catalog.use_dump(args.rdf_dump)
+    if args.check_parallel:
+        sys.exit(0 if check_parallel(main, max(args.workers, 2), args.db) else 1)
+    main(args.db, "cache/analysis_state.pickle" if args.incremental else None, args.workers)
@@ -0,0 +1,420 @@
+import os
+import io
+import csv
+import json
+import gzip
+import time
+import random
+import argparse
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageChops, ImageFilter
+from tqdm import tqdm
+from identifiers import isbn10_to_13
+from db_stream import iter_records
+from imglist_store import ImageListStore
+from metrics import METRICS
+from decoders import PROFILES, check_chain
+import catalog
+import create_db
+
+#
+# Offline benchmark of the scan pipeline of create_db.py on a synthetic corpus:
+#
+#   python benchmark.py generate bench/ --works 50
+#   python benchmark.py run bench/ --s3-latency 0.05 -j 8
+#
+# generate writes page images with rendered EAN-13 barcodes (varied sizes,
+# rotations, noise and jpeg settings) in the S3 layout of get_s3_folder_prefix,
+# with their dimensions.json, and a matching mw-w-ig-vn.csv / mw-isbn.csv.
+# The expected barcode of each image group is in truth.json.
+# run scans the corpus through local_s3.DirS3Client and reports the throughput,
+# the latency percentiles per image group and the detection recall.
+#
+#   python benchmark.py profiles --decoders zbar,zbar-ean,zbar-ean-fast --sample 200
+#
+# profiles compares decoders (typically the zbar profiles of decoders.py) on a
+# sample of the images of db.yml, with and without EAN-13, read from S3 (or --s3-dir):
+# time per image and share of the stored EAN-13 found again. With --bench bench/
+# the sample is taken from a synthetic corpus instead, where some of the EAN-13
+# have an EAN-5 add-on.
+#
+
+# EAN-13 encoding: L codes, the R codes are their complement and the G codes the reversed R codes
+EAN_L = ["0001101", "0011001", "0010011", "0111101", "0100011", "0110001", "0101111", "0111011", "0110111", "0001011"]
+# parity (L or G) of the 6 left digits, depending on the first digit
+EAN_PARITY = ["LLLLLL", "LLGLGG", "LLGGLG", "LLGGGL", "LGLLGG", "LGGLLG", "LGGGLL", "LGLGLG", "LGLGGL", "LGGLGL"]
+# parity of the 5 digits of an EAN-5 add-on, depending on its checksum
+EAN5_PARITY = ["GGLLL", "GLGLL", "GLLGL", "GLLLG", "LGGLL", "LLGGL", "LLLGG", "LGLGL", "LGLLG", "LLGLG"]
+
+MODULE_SIZES = [1, 2, 3, 4]
+ROTATIONS = [0, 0, 0, 5, -8, 15, 30]
+NOISE_SIGMAS = [0, 0, 10, 25]
+PAGE_SIZES = [(1000, 1400), (1600, 2300), (2400, 3400)]
+# share of the image groups without a barcode
+NO_BARCODE_RATIO = 0.2
+# share of the barcodes with an EAN-5 price add-on
+ADDON_RATIO = 0.3
+# number of images written at the beginning and end of each image group,
+# the pipeline never looks at the other ones (see ordered_imglist)
+NB_TIP_FILES = 10
+
+def ean13_modules(ean):
+    # string of 95 "0"/"1" modules
+    r = [''.join('1' if c == '0' else '0' for c in code) for code in EAN_L]
+    res = "101"
+    for d, parity in zip(ean[1:7], EAN_PARITY[int(ean[0])]):
+        res += EAN_L[int(d)] if parity == "L" else r[int(d)][::-1]
+    res += "01010"
+    for d in ean[7:]:
+        res += r[int(d)]
+    return res + "101"
+
+def ean5_modules(addon):
+    # string of 47 "0"/"1" modules of the add-on
+    checksum = (3 * sum(int(d) for d in addon[0::2]) + 9 * sum(int(d) for d in addon[1::2])) % 10
+    r = [''.join('1' if c == '0' else '0' for c in code) for code in EAN_L]
+    res = "1011"
+    for i, (d, parity) in enumerate(zip(addon, EAN5_PARITY[checksum])):
+        if i:
+            res += "01"
+        res += EAN_L[int(d)] if parity == "L" else r[int(d)][::-1]
+    return res
+
+def render_ean13(ean, module, addon=None):
+    """
+    barcode with its quiet zone and the digits under it, module is the width of a bar
+    in pixels. The EAN-5 add-on is 9 modules right of the EAN-13, with its digits above.
+    """
+    modules = ean13_modules(ean)
+    quiet = 11 * module
+    height = 60 * module
+    width = len(modules) * module + 2 * quiet
+    if addon is not None:
+        addon_left = quiet + (len(modules) + 9) * module
+        width = addon_left + 47 * module + 5 * module
+    img = Image.new("L", (width, height + 14 * module), 255)
+    draw = ImageDraw.Draw(img)
+    for i, m in enumerate(modules):
+        if m == "1":
+            draw.rectangle([quiet + i * module, 4 * module, quiet + (i + 1) * module - 1, 4 * module + height], fill=0)
+    draw.text((quiet, height + 6 * module), ean, fill=0)
+    if addon is not None:
+        for i, m in enumerate(ean5_modules(addon)):
+            if m == "1":
+                draw.rectangle([addon_left + i * module, 12 * module, addon_left + (i + 1) * module - 1, 4 * module + height], fill=0)
+        draw.text((addon_left, 2 * module), addon, fill=0)
+    return img
+
+def random_isbn13(rnd):
+    # 978 + 9 random digits + checksum
+    return isbn10_to_13("".join(str(rnd.randrange(10)) for _ in range(9)))
+
+def render_page(rnd, size, barcode=None):
+    """
+    grayscale page with some lines of "text", and optionally a barcode (a dict
+    with the ean, add-on, module size, rotation and noise sigma) in the lower part
+    """
+    page = Image.new("L", size, rnd.randint(215, 250))
+    draw = ImageDraw.Draw(page)
+    w, h = size
+    for y in range(h // 10, h // 2, max(h // 40, 10)):
+        draw.rectangle([w // 10, y, w // 10 + rnd.randint(w // 3, w * 8 // 10), y + h // 150], fill=rnd.randint(40, 120))
+    if barcode is not None:
+        bc = render_ean13(barcode["ean"], barcode["module"], barcode["addon"])
+        if barcode["rotation"]:
+            bc = bc.rotate(barcode["rotation"], resample=Image.BILINEAR, expand=True, fillcolor=255)
+        l = rnd.randint(0, max(0, w - bc.size[0]))
+        t = rnd.randint(h // 2, max(h // 2, h - bc.size[1]))
+        page.paste(bc, (l, t))
+    if barcode is not None and barcode["noise"]:
+        # zero centered gaussian noise
+        page = ImageChops.add(page, Image.effect_noise(size, barcode["noise"]), 1, -128)
+    if rnd.random() < 0.2:
+        page = page.filter(ImageFilter.GaussianBlur(0.8))
+    return page
+
+def jpeg_bytes(rnd, page):
+    f = io.BytesIO()
+    page.save(f, format="JPEG", quality=rnd.randint(50, 95), progressive=rnd.random() < 0.5)
+    return f.getvalue()
+
+def generate(root, nb_works=50, seed=1):
+    rnd = random.Random(seed)
+    root = Path(root)
+    os.makedirs(str(root), exist_ok=True)
+    truth = {}
+    with open(str(root / "mw-w-ig-vn.csv"), 'w', newline='') as wf, open(str(root / "mw-isbn.csv"), 'w', newline='') as isbnf:
+        wwriter = csv.writer(wf)
+        isbnwriter = csv.writer(isbnf)
+        for wi in range(nb_works):
+            mw = "MWBENCH%04d" % wi
+            w = "WBENCH%04d" % wi
+            nb_vols = 1 if rnd.random() < 0.7 else rnd.randint(2, 5)
+            isbns = []
+            for vn in range(1, nb_vols + 1):
+                ig = "IBENCH%04d_%d" % (wi, vn)
+                nb_imgs = rnd.randint(25, 400)
+                ti = rnd.choice([0, 0, 2])
+                size = rnd.choice(PAGE_SIZES)
+                fnames = ["%s_%04d.jpg" % (ig, i + 1) for i in range(nb_imgs)]
+                # the barcode is most often on the back cover
+                barcode = None
+                if rnd.random() >= NO_BARCODE_RATIO:
+                    pos = rnd.choice([nb_imgs - 1, nb_imgs - 1, nb_imgs - 2, nb_imgs - 3, ti, ti + 1, ti + 3])
+                    barcode = {
+                        "ean": random_isbn13(rnd),
+                        "fname": fnames[pos],
+                        "module": rnd.choice(MODULE_SIZES),
+                        "rotation": rnd.choice(ROTATIONS),
+                        "noise": rnd.choice(NOISE_SIGMAS),
+                        "addon": "".join(str(rnd.randrange(10)) for _ in range(5)) if rnd.random() < ADDON_RATIO else None
+                    }
+                    isbns.append(barcode["ean"])
+                truth[ig] = barcode
+                wwriter.writerow([mw, w, ig, vn, ti])
+                prefix = root / create_db.get_s3_folder_prefix(w, ig)
+                os.makedirs(str(prefix), exist_ok=True)
+                dimensions = [{"filename": fname, "width": size[0], "height": size[1]} for fname in fnames]
+                with open(str(prefix / "dimensions.json"), 'wb') as f:
+                    f.write(gzip.compress(json.dumps(dimensions).encode('utf-8')))
+                for i, fname in enumerate(fnames):
+                    if NB_TIP_FILES <= i < nb_imgs - NB_TIP_FILES:
+                        continue
+                    page = render_page(rnd, size, barcode if barcode is not None and fname == barcode["fname"] else None)
+                    with open(str(prefix / fname), 'wb') as f:
+                        f.write(jpeg_bytes(rnd, page))
+            if isbns:
+                isbnwriter.writerow([mw, ",".join(isbns)])
+    with open(str(root / "truth.json"), 'w') as f:
+        json.dump(truth, f, indent=1, sort_keys=True)
+    print("%d works, %d image groups written in %s" % (nb_works, len(truth), root))
+
+def percentile(values, p):
+    # nearest rank percentile of a sorted list
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+def run(root, nb_workers=1, nb_decode_workers=0, latency=0, output=None):
+    root = Path(root)
+    with open(str(root / "truth.json")) as f:
+        truth = json.load(f)
+    cat = catalog.read_csvs(str(root / "mw-w-ig-vn.csv"), str(root / "mw-isbn.csv"))
+    w_infos = catalog.WInfos(cat)
+    create_db.init_s3(str(root), latency)
+    # the image lists are read from the corpus at each run
+    il_path = root / "il.sqlite"
+    if il_path.is_file():
+        os.remove(str(il_path))
+    create_db.IL_STORE = ImageListStore(str(il_path))
+    if create_db.CONFIG["prefetch"] > 0:
+        create_db.PREFETCH_POOL = ThreadPoolExecutor(max_workers=nb_workers * (create_db.CONFIG["prefetch"] + 1))
+    decode_pool = ProcessPoolExecutor(max_workers=nb_decode_workers) if nb_decode_workers > 0 else None
+    results = {}
+    lock = threading.Lock()
+    def scan_ig(w, ig):
+        ig_info = w_infos[w][ig]
+        db_ig_info = {"n": ig_info["n"]}
+        start = time.perf_counter()
+        create_db.process_ig(w, ig, ig_info, db_ig_info, decode_pool=decode_pool, mw=w_infos[w]["ro"])
+        latency = time.perf_counter() - start
+        with lock:
+            results[ig] = (latency, db_ig_info)
+    igs = [(w, ig) for w in sorted(w_infos) for ig in w_infos[w] if ig != "ro"]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=nb_workers) as pool:
+        for future in [pool.submit(scan_ig, w, ig) for w, ig in igs]:
+            future.result()
+    wall_time = time.perf_counter() - start
+    if decode_pool is not None:
+        decode_pool.shutdown()
+    report = get_report(truth, results, wall_time)
+    report["config"] = dict(create_db.CONFIG, workers=nb_workers, decode_workers=nb_decode_workers, s3_latency=latency)
+    report["metrics"] = METRICS.to_dict()
+    print_report(report)
+    print(METRICS.summary())
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+def get_report(truth, results, wall_time):
+    latencies = sorted(latency for latency, db_ig_info in results.values())
+    nb_imgs = 0
+    found = 0
+    wrong = 0
+    # recall per value of each generation parameter
+    by_param = {"module": {}, "rotation": {}, "noise": {}, "addon": {}}
+    for ig, (latency, db_ig_info) in results.items():
+        nb_imgs += len(db_ig_info) - 1
+        eans = set(det["d"] for fname, dets in db_ig_info.items() if fname != "n" for det in dets if det["t"] == "EAN13")
+        barcode = truth.get(ig)
+        if barcode is None:
+            wrong += len(eans)
+            continue
+        ok = barcode["ean"] in eans
+        found += ok
+        wrong += len(eans - {barcode["ean"]})
+        for param, counts in by_param.items():
+            # with or without an add-on, not the add-on itself
+            value = barcode.get(param) is not None if param == "addon" else barcode[param]
+            c = counts.setdefault(str(value), [0, 0])
+            c[0] += ok
+            c[1] += 1
+    nb_barcodes = len([b for b in truth.values() if b is not None])
+    return {
+        "igs": len(results),
+        "images": nb_imgs,
+        "wall_time": wall_time,
+        "igs_per_s": len(results) / wall_time if wall_time else None,
+        "images_per_s": nb_imgs / wall_time if wall_time else None,
+        "latency": {"p50": percentile(latencies, 50), "p90": percentile(latencies, 90), "p99": percentile(latencies, 99), "max": latencies[-1] if latencies else None},
+        "recall": found / nb_barcodes if nb_barcodes else None,
+        "wrong_eans": wrong,
+        "recall_by": {param: {k: c[0] / c[1] for k, c in sorted(counts.items())} for param, counts in by_param.items()}
+    }
+
+def print_report(report):
+    print("%d image groups, %d images in %.1fs: %.2f image groups/s, %.2f images/s" % (report["igs"], report["images"], report["wall_time"], report["igs_per_s"] or 0, report["images_per_s"] or 0))
+    if report["latency"]["p50"] is not None:
+        print("latency per image group: p50 %.3fs, p90 %.3fs, p99 %.3fs, max %.3fs" % (report["latency"]["p50"], report["latency"]["p90"], report["latency"]["p99"], report["latency"]["max"]))
+    if report["recall"] is not None:
+        print("recall: %.1f%%, %d wrong EAN13" % (100 * report["recall"], report["wrong_eans"]))
+    for param, recalls in report["recall_by"].items():
+        print("  recall by %s: %s" % (param, ", ".join("%s: %.1f%%" % (k, 100 * r) for k, r in recalls.items())))
+
+def sample_stored(db_path="db.yml", nb=100, seed=1):
+    """
+    random sample of nb images of the db with an EAN-13 and nb without,
+    as (w, ig, fname, stored EAN-13 set, stored EAN-5 set)
+    """
+    rnd = random.Random(seed)
+    samples = {True: [], False: []}
+    seen = {True: 0, False: 0}
+    for w, ig, fname, detections in iter_records(db_path):
+        eans = set(det["d"] for det in detections if det["t"] == "EAN13")
+        addons = set(det["d"] for det in detections if det["t"] == "EAN5")
+        has_ean = len(eans) > 0
+        seen[has_ean] += 1
+        # reservoir sampling
+        if len(samples[has_ean]) < nb:
+            samples[has_ean].append((w, ig, fname, eans, addons))
+        else:
+            i = rnd.randrange(seen[has_ean])
+            if i < nb:
+                samples[has_ean][i] = (w, ig, fname, eans, addons)
+    return samples[True] + samples[False]
+
+def sample_bench(root, nb=100, seed=1):
+    """
+    same as sample_stored on a synthetic corpus: nb images with a barcode and nb
+    images of the image groups without one, with the EAN-13 and add-on of truth.json
+    """
+    rnd = random.Random(seed)
+    root = Path(root)
+    with open(str(root / "truth.json")) as f:
+        truth = json.load(f)
+    with_ean = []
+    without_ean = []
+    with open(str(root / "mw-w-ig-vn.csv"), newline='') as f:
+        for mw, w, ig, vn, ti in csv.reader(f):
+            barcode = truth.get(ig)
+            if barcode is not None:
+                with_ean.append((w, ig, barcode["fname"], {barcode["ean"]}, {barcode["addon"]} if barcode.get("addon") else set()))
+                continue
+            prefix = root / create_db.get_s3_folder_prefix(w, ig)
+            for fname in sorted(os.listdir(str(prefix))):
+                if fname.endswith(".jpg"):
+                    without_ean.append((w, ig, fname, set(), set()))
+    return rnd.sample(with_ean, min(nb, len(with_ean))) + rnd.sample(without_ean, min(nb, len(without_ean)))
+
+def compare_decoders(decoders, sample, output=None):
+    stats = {name: {"images": 0, "seconds": 0.0, "expected": 0, "found": 0, "new": 0, "addons_expected": 0, "addons_found": 0} for name in decoders}
+    for w, ig, fname, eans, addons in tqdm(sample):
+        key = create_db.get_s3_folder_prefix(w, ig)+fname
+        blob = create_db.gets3blob(key)
+        if blob is None:
+            continue
+        try:
+            img = Image.open(blob)
+            img.load()
+        except:
+            continue
+        small = create_db.get_small(img)
+        for name in decoders:
+            start = time.perf_counter()
+            dets, found = create_db.get_detections(img, create_db.CONFIG["passes"], small, [name])
+            st = stats[name]
+            st["seconds"] += time.perf_counter() - start
+            st["images"] += 1
+            got = set(det["d"] for det in dets if det["t"] == "EAN13")
+            st["expected"] += len(eans)
+            st["found"] += len(got & eans)
+            st["new"] += len(got - eans)
+            st["addons_expected"] += len(addons)
+            st["addons_found"] += len(addons & set(det["d"] for det in dets if det["t"] == "EAN5"))
+    for name, st in stats.items():
+        if not st["images"]:
+            continue
+        print("%-16s %.3fs per image, %d/%d stored EAN-13 found (%.1f%%), %d not in the db" % (name, st["seconds"] / st["images"], st["found"], st["expected"], 100 * st["found"] / st["expected"] if st["expected"] else 0, st["new"]))
+        if st["addons_expected"]:
+            print("%-16s %d/%d EAN-5 add-ons found" % ("", st["addons_found"], st["addons_expected"]))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(stats, f, indent=1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="offline benchmark of the scan pipeline on a synthetic corpus")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    gen_parser = subparsers.add_parser("generate", help="write a synthetic corpus in a directory")
+    gen_parser.add_argument("dir")
+    gen_parser.add_argument("--works", type=int, default=50, help="number of works")
+    gen_parser.add_argument("--seed", type=int, default=1)
+    run_parser = subparsers.add_parser("run", help="scan a synthetic corpus and report throughput, latency and recall")
+    run_parser.add_argument("dir")
+    run_parser.add_argument("-j", "--workers", type=int, default=1, help="number of threads scanning image groups")
+    run_parser.add_argument("--decode-workers", type=int, default=0, help="number of processes decoding barcodes (0 = in the scanning threads)")
+    run_parser.add_argument("--s3-latency", type=float, default=0, help="artificial latency in seconds added to each request")
+    run_parser.add_argument("--reduced-fetch", action="store_true")
+    run_parser.add_argument("--passes", help="comma separated list of detection passes")
+    run_parser.add_argument("--prefetch", type=int, default=0)
+    run_parser.add_argument("--decoders", help="comma separated chain of barcode decoders")
+    run_parser.add_argument("--compare-decoders", action="store_true")
+    run_parser.add_argument("-o", "--output", help="write the report in this json file")
+    profiles_parser = subparsers.add_parser("profiles", help="compare decoders on a sample of the images of db.yml")
+    profiles_parser.add_argument("--decoders", default=",".join(PROFILES), help="comma separated list of the decoders to compare")
+    profiles_parser.add_argument("--db", default="db.yml", help="db.yml or db.sqlite")
+    profiles_parser.add_argument("--bench", help="take the sample from this synthetic corpus (written by generate) instead of the db")
+    profiles_parser.add_argument("--sample", type=int, default=100, help="number of images with an EAN-13, and of images without")
+    profiles_parser.add_argument("--seed", type=int, default=1)
+    profiles_parser.add_argument("--passes", help="comma separated list of detection passes")
+    profiles_parser.add_argument("--s3-dir", help="read the images from this local directory instead of the bucket")
+    profiles_parser.add_argument("-o", "--output", help="write the results in this json file")
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate(args.dir, args.works, args.seed)
+    elif args.command == "profiles":
+        decoders = args.decoders.split(",")
+        try:
+            check_chain(decoders)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.passes:
+            create_db.CONFIG["passes"] = args.passes.split(",")
+        if args.bench:
+            create_db.init_s3(args.s3_dir or args.bench)
+            sample = sample_bench(args.bench, args.sample, args.seed)
+        else:
+            create_db.init_s3(args.s3_dir)
+            sample = sample_stored(args.db, args.sample, args.seed)
+        compare_decoders(decoders, sample, args.output)
+    else:
+        create_db.CONFIG["reduced_fetch"] = args.reduced_fetch
+        create_db.CONFIG["prefetch"] = args.prefetch
+        if args.passes:
+            create_db.CONFIG["passes"] = args.passes.split(",")
+        if args.decoders:
+            create_db.CONFIG["decoders"] = args.decoders.split(",")
+        create_db.CONFIG["compare_decoders"] = args.compare_decoders
+        run(args.dir, args.workers, args.decode_workers, args.s3_latency, args.output)
@@ -0,0 +1,204 @@
+import csv
+import os
+import sys
+import pickle
+from array import array
+from collections.abc import Mapping
+
+#
+# In-memory catalog of mw-w-ig-vn.csv and mw-isbn.csv, shared by the scripts.
+# The RIDs are interned in a single table and the rows are stored as columns
+# of integers (indexes in the RID table, volume number, intro pages).
+# A pickled copy is kept in cache/catalog.pickle and reused as long as the
+# csv files don't change. The catalog can also be read from a local RDF dump
+# instead of the csv files, see use_dump() and rdf_catalog.py.
+#
+
+CACHE_VERSION = 1
+
+class Catalog:
+
+    def __init__(self):
+        self.rids = []
+        self.rid_idx = {}
+        # mw-w-ig-vn.csv columns
+        self.mw = array('i')
+        self.w = array('i')
+        self.ig = array('i')
+        self.vn = array('i')
+        self.ti = array('i')
+        # mw-isbn.csv columns
+        self.isbn_mw = array('i')
+        self.isbn_str = []
+        # indexes: rid index -> row indexes
+        self.w_rows = {}
+        self.mw_rows = {}
+        self.mw_isbn_rows = {}
+
+    def intern(self, rid):
+        idx = self.rid_idx.get(rid)
+        if idx is None:
+            idx = len(self.rids)
+            self.rids.append(sys.intern(rid))
+            self.rid_idx[rid] = idx
+        return idx
+
+    def add_w_row(self, mw, w, ig, vn, ti):
+        row = len(self.w)
+        mwi = self.intern(mw)
+        wi = self.intern(w)
+        self.mw.append(mwi)
+        self.w.append(wi)
+        self.ig.append(self.intern(ig))
+        self.vn.append(vn)
+        self.ti.append(ti)
+        self.w_rows.setdefault(wi, []).append(row)
+        self.mw_rows.setdefault(mwi, []).append(row)
+
+    def add_isbn_row(self, mw, isbn_str):
+        row = len(self.isbn_str)
+        mwi = self.intern(mw)
+        self.isbn_mw.append(mwi)
+        self.isbn_str.append(isbn_str)
+        self.mw_isbn_rows.setdefault(mwi, []).append(row)
+
+    def w_info(self, w):
+        """
+        information on a work in the format of create_db.get_w_infos():
+        {"ro": mw, ig: {"n": volume number, "ti": nb of tbrc intro pages}}
+        """
+        rows = self.w_rows[self.rid_idx[w]]
+        res = {}
+        for row in rows:
+            res["ro"] = self.rids[self.mw[row]]
+            res[self.rids[self.ig[row]]] = {
+                "n": self.vn[row],
+                "ti": self.ti[row]
+            }
+        return res
+
+    def ws(self):
+        return [self.rids[wi] for wi in self.w_rows]
+
+    def mws(self):
+        return [self.rids[mwi] for mwi in self.mw_rows]
+
+    def w_to_mw(self, w):
+        return self.rids[self.mw[self.w_rows[self.rid_idx[w]][-1]]]
+
+    def mw_to_ws(self, mw):
+        res = []
+        for row in self.mw_rows.get(self.rid_idx.get(mw), []):
+            w = self.rids[self.w[row]]
+            if w not in res:
+                res.append(w)
+        return res
+
+    def ig_to_w(self):
+        res = {}
+        for row in range(len(self.w)):
+            res[self.rids[self.ig[row]]] = self.rids[self.w[row]]
+        return res
+
+    def iter_isbn_rows(self):
+        # (mw, isbn string) in the order of mw-isbn.csv
+        for row in range(len(self.isbn_str)):
+            yield self.rids[self.isbn_mw[row]], self.isbn_str[row]
+
+    def mw_isbns(self, mw):
+        return [self.isbn_str[row] for row in self.mw_isbn_rows.get(self.rid_idx.get(mw), [])]
+
+    def has_w(self, w):
+        return w in self.rid_idx and self.rid_idx[w] in self.w_rows
+
+class WInfos(Mapping):
+    # read only dict-like view w -> w_info, the w_info are built on access
+    def __init__(self, catalog):
+        self.catalog = catalog
+    def __getitem__(self, w):
+        if not self.catalog.has_w(w):
+            raise KeyError(w)
+        return self.catalog.w_info(w)
+    def __iter__(self):
+        return iter(self.catalog.ws())
+    def __len__(self):
+        return len(self.catalog.w_rows)
+    def __contains__(self, w):
+        return self.catalog.has_w(w)
+
+class WToMW(Mapping):
+    # read only dict-like view w -> mw
+    def __init__(self, catalog):
+        self.catalog = catalog
+    def __getitem__(self, w):
+        if not self.catalog.has_w(w):
+            raise KeyError(w)
+        return self.catalog.w_to_mw(w)
+    def __iter__(self):
+        return iter(self.catalog.ws())
+    def __len__(self):
+        return len(self.catalog.w_rows)
+    def __contains__(self, w):
+        return self.catalog.has_w(w)
+
+def read_csvs(w_path, isbn_path):
+    catalog = Catalog()
+    with open(w_path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        for row in reader:
+            catalog.add_w_row(row[0], row[1], row[2], int(row[3]), int(row[4]))
+    with open(isbn_path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        for row in reader:
+            catalog.add_isbn_row(row[0], row[1])
+    return catalog
+
+def file_signature(path):
+    st = os.stat(path)
+    return (path, st.st_size, st.st_mtime_ns)
+
+CATALOG = None
+# RDF dump the catalog is read from instead of the csv files
+DUMP_PATH = None
+
+def use_dump(path):
+    global CATALOG, DUMP_PATH
+    DUMP_PATH = path
+    CATALOG = None
+
+def load_catalog(w_path='mw-w-ig-vn.csv', isbn_path='mw-isbn.csv', cache_path='cache/catalog.pickle'):
+    """
+    returns the catalog, from the pickled cache if the csv files haven't changed
+    (the catalog is loaded only once per process)
+    """
+    global CATALOG
+    if CATALOG is not None:
+        return CATALOG
+    if DUMP_PATH is not None:
+        from rdf_catalog import load_dump_catalog
+        CATALOG = load_dump_catalog(DUMP_PATH)
+        return CATALOG
+    signature = (CACHE_VERSION, file_signature(w_path), file_signature(isbn_path))
+    if cache_path is not None and os.path.isfile(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_signature, catalog = pickle.load(f)
+            if cached_signature == signature:
+                CATALOG = catalog
+                return CATALOG
+        except Exception:
+            pass
+    CATALOG = read_csvs(w_path, isbn_path)
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmppath = cache_path+".tmp"
+        with open(tmppath, 'wb') as f:
+            pickle.dump((signature, CATALOG), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, cache_path)
+    return CATALOG
+
+def get_w_infos():
+    return WInfos(load_catalog())
+
+def get_w_to_mw():
+    return WToMW(load_catalog())
@@ -5,17 +5,97 @@ import io
 from tqdm import tqdm
 import boto3
 import botocore
+import botocore.config
 import gzip
 import csv
-from pyzbar.pyzbar import decode
-from PIL import Image
+from PIL import Image, PngImagePlugin
 from pathlib import Path
 import os
 import hashlib
 import json
+import math
+import argparse
+import time
+import threading
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scan_store import ScanStore
+from decoders import BACKENDS, DEFAULT_CHAIN, EAN_TYPES, check_chain
+from metrics import METRICS
+import catalog
+from local_s3 import DirS3Client
+from img_cache import ImageCache
+from imglist_store import ImageListStore
+from key_manifest import KeyManifest
+from page_order import PageOrderModel, VolumeSchedule, ordered_positions, position_label, label_index, find_index, get_strata, get_mw_pub_prefixes, expected_fetches, train, print_report
+
+# set by init_s3()
+S3 = None
+# pool of threads downloading the next images of an image group in advance
+PREFETCH_POOL = None
+# optional on disk cache of the images
+IMG_CACHE = None
+# image lists of all the image groups, set in main()
+IL_STORE = None
+# learned page order (see page_order.py), None for the heuristic order of ordered_imglist
+ORDER_MODEL = None
+MW_PUB_PREFIXES = {}
+# expected vs actual number of images fetched per image group with the learned order
+ORDER_REPORT = {"igs": 0, "expected": 0, "actual": 0}
+ORDER_REPORT_LOCK = threading.Lock()
+# in delta mode, (w, ig) -> current fingerprint of the scheduled image groups (see get_delta_w_infos)
+DELTA_FPS = {}
+
+# in reduced fetch mode, the number of bytes fetched first
+PARTIAL_BYTES = 256 * 1024
+
+# passes of the barcode detection, see get_detections
+DETECTION_PASSES = ["small", "roi", "full", "rot"]
+# passes used by default: a page without barcode goes through all of them, the small
+# copy adds 20-45% to the pixels of the full image, rot 1.4-3x, so it has to be asked for
+DEFAULT_PASSES = ["small", "full"]
+# max width or height of the downscaled image used in the "small" and "rot" passes
+SMALL_MAX_SIZE = 1600
+# angles tried in the "rot" pass
+ROT_ANGLES = [15, -15, 30, -30]
+# passes that only need the downscaled copy
+SMALL_PASSES = ["small", "rot"]
+# in verify mode, margin around the stored rect of a barcode, relative to its largest side
+VERIFY_MARGIN = 0.5
+
+CONFIG = {
+    "reduced_fetch": False,
+    "passes": DEFAULT_PASSES,
+    # number of images downloaded in advance in each image group
+    "prefetch": 0,
+    # also keep the downscaled grayscale version of the images in the image cache
+    "cache_small": False,
+    # chain of decoder backends (see decoders.py)
+    "decoders": DEFAULT_CHAIN,
+    # run all the decoders of the chain and count their agreement
+    "compare_decoders": False,
+    # scheduling of the volumes of multi-volume works, see page_order.VolumeSchedule
+    # ("off" = the image groups are scanned independently)
+    "mv_policy": "off",
+    # number of volumes with the same EAN at the same position before the policy applies
+    "mv_confirm": 3
+}
+
+def init_s3(local_dir=None, latency=0, max_pool_connections=10):
+    """
+    creates the S3 client used by the whole script. If local_dir is given,
+    the keys are read from files in that directory instead (for offline tests
+    and benchmarks), with an optional artificial latency per request.
+    """
+    global S3
+    if local_dir is not None:
+        S3 = DirS3Client(local_dir, latency)
+        return
+    session = boto3.Session(profile_name='thumbnailgen')
+    # the client is shared by all the download threads, it needs enough connections in its pool
+    S3 = session.client('s3', config=botocore.config.Config(max_pool_connections=max_pool_connections))
 
-SESSION = boto3.Session(profile_name='thumbnailgen')
-S3 = SESSION.client('s3')
 
 # use yaml.CSafeLoader / if available but don't crash if it isn't
 try:
@@ -28,6 +108,18 @@ try:
 except (ImportError, AttributeError):
     yaml_dumper = yaml.SafeDumper
 
+def get_md5_two(iiLocalName):
+    # first two characters of the md5 of the work id, as used in the S3 layout
+    md5 = hashlib.md5(str.encode(iiLocalName))
+    return md5.hexdigest()[:2]
+
+def get_shard(iiLocalName, nb_shards):
+    # works are distributed among shards according to the whole md5 of the work id
+    # (the two characters of the S3 layout would only give 256 buckets)
+    return int(hashlib.md5(str.encode(iiLocalName)).hexdigest(), 16) % nb_shards
+
+# called for every image and image list, the result only depends on the arguments
+@lru_cache(maxsize=None)
 def get_s3_folder_prefix(iiLocalName, igLocalName):
     """
     gives the s3 prefix (~folder) in which the volume will be present.
@@ -42,8 +134,7 @@ def get_s3_folder_prefix(iiLocalName, igLocalName):
           * the image group ID without the initial "I" if the image group ID is in the form I\\d\\d\\d\\d
           * or else the full image group ID (incuding the "I")
     """
-    md5 = hashlib.md5(str.encode(iiLocalName))
-    two = md5.hexdigest()[:2]
+    two = get_md5_two(iiLocalName)
 
     pre, rest = igLocalName[0], igLocalName[1:]
     if pre == 'I' and rest.isdigit() and len(rest) == 4:
@@ -57,6 +148,7 @@ def gets3blob(s3Key):
     f = io.BytesIO()
     try:
         S3.download_fileobj('archive.tbrc.org', s3Key, f)
+        METRICS.incr("bytes_downloaded", f.tell())
         return f
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == '404':
@@ -64,8 +156,37 @@ def gets3blob(s3Key):
         else:
             raise
 
+def gets3range(s3Key, start, end=None):
+    # returns (bytes, total size of the object) or None
+    r = "bytes=%d-" % start if end is None else "bytes=%d-%d" % (start, end)
+    try:
+        with METRICS.timer("image_fetch"):
+            resp = S3.get_object(Bucket='archive.tbrc.org', Key=s3Key, Range=r)
+            b = resp['Body'].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'InvalidRange']:
+            return None
+        else:
+            raise
+    METRICS.incr("bytes_downloaded", len(b))
+    # ContentRange is "bytes start-end/total"
+    total = int(resp['ContentRange'].split('/')[1])
+    return b, total
+
+def get_dimensions_etag(iiLocalName, igLocalName):
+    # ETag of the dimensions.json of the image group, None if there's none
+    s3key = get_s3_folder_prefix(iiLocalName, igLocalName)+"dimensions.json"
+    try:
+        resp = S3.head_object(Bucket='archive.tbrc.org', Key=s3key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+            return None
+        else:
+            raise
+    return resp['ETag']
+
 # This has a cache mechanism
-def getImageList(iiLocalName, igLocalName, force=False, getmissing=True):
+def getImageList(iiLocalName, igLocalName, force=False, getmissing=True, writecache=True):
     cachepath = Path("cache/il/"+igLocalName+".json.gz")
     if not force and cachepath.is_file():
         with gzip.open(str(cachepath), 'r') as gzipfile:
@@ -86,10 +207,35 @@ def getImageList(iiLocalName, igLocalName, force=False, getmissing=True):
     ub = gzip.decompress(b)
     s = ub.decode('utf8')
     data = json.loads(s)
-    with gzip.open(str(cachepath), 'w') as gzipfile:
-        gzipfile.write(json.dumps(data).encode('utf-8'))
+    if writecache:
+        with gzip.open(str(cachepath), 'w') as gzipfile:
+            gzipfile.write(json.dumps(data).encode('utf-8'))
     return data
 
+def getFileNames(iiLocalName, igLocalName):
+    """
+    returns the filenames of the image group, from the image list store when
+    it's used. In that case the result only has the first and last 10 filenames
+    (see ordered_imglist).
+    """
+    if IL_STORE is None:
+        with METRICS.timer("list_fetch"):
+            flist = getImageList(iiLocalName, igLocalName)
+        return [f["filename"] for f in flist] if flist is not None else None
+    res = IL_STORE.get_head_tail(igLocalName, 10, 10)
+    if res is not None:
+        METRICS.incr("il_cache_hits")
+        return res
+    METRICS.incr("il_cache_misses")
+    # the old cache/il/ files are still read, but not written anymore
+    with METRICS.timer("list_fetch"):
+        flist = getImageList(iiLocalName, igLocalName, writecache=False)
+    if flist is None:
+        return None
+    fnames = [f["filename"] for f in flist]
+    IL_STORE.put(igLocalName, fnames)
+    return fnames
+
 def getimg(wlname, iglname, fname):
     key = get_s3_folder_prefix(wlname, iglname)+fname
     blob = gets3blob(key)
@@ -99,6 +245,231 @@ def getimg(wlname, iglname, fname):
         print("error with image "+key)
         return None
 
+def is_progressive_jpeg(b):
+    # looks for a SOF2 marker in the segments before the first scan
+    if b[:2] != b'\xff\xd8':
+        return False
+    i = 2
+    while i + 4 <= len(b):
+        if b[i] != 0xFF:
+            return False
+        marker = b[i+1]
+        if marker == 0xC2:
+            return True
+        if marker in [0xC0, 0xC1, 0xC3, 0xDA]:
+            return False
+        i += 2 + int.from_bytes(b[i+2:i+4], 'big')
+    return False
+
+def save_small(small, path):
+    # saves the downscaled copy in a png, with the factor to the original size
+    img, factor = small
+    info = PngImagePlugin.PngInfo()
+    info.add_text("factor", str(factor))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmppath = path+".%d.tmp" % os.getpid()
+    img.save(tmppath, format="PNG", pnginfo=info)
+    os.replace(tmppath, path)
+
+def detect_small_blob(key, b, passes=None, decoders=None, compare=False, times=None, counts=None):
+    # detection on a downscaled copy saved by save_small, only the passes that don't need the full image are run
+    # times and counts are optional dicts where the time spent in each stage and the decoder counters are recorded
+    if passes is None:
+        passes = DEFAULT_PASSES
+    if times is None:
+        times = {}
+    start = time.perf_counter()
+    try:
+        img = Image.open(io.BytesIO(b))
+        factor = float(img.info.get("factor", 1))
+        img.load()
+    except:
+        return None
+    times["pil_decode"] = time.perf_counter() - start
+    start = time.perf_counter()
+    res = get_detections(None, [p for p in passes if p in SMALL_PASSES], (img, factor), decoders, compare, times, counts)
+    times["barcode_decode"] = time.perf_counter() - start
+    return res
+
+def detect_blob(key, b, partial=False, passes=None, small_path=None, decoders=None, compare=False, times=None, counts=None):
+    # can run in the decoding processes, b is the raw content of the image
+    # partial means that b is the beginning of a progressive jpeg
+    # if small_path is set, the downscaled copy is saved there
+    # times and counts are optional dicts where the time spent in each stage and the decoder counters are recorded
+    if times is None:
+        times = {}
+    start = time.perf_counter()
+    try:
+        if partial:
+            # decode the scans that are complete, which gives a full but blurrier image.
+            # An EOI marker ends the truncated data instead of ImageFile.LOAD_TRUNCATED_IMAGES,
+            # which is global to the process and would also apply to the other decodes
+            b = b + b'\xff\xd9'
+        img = Image.open(io.BytesIO(b))
+        img.load()
+    except:
+        if not partial:
+            print("error with image "+key)
+        return None
+    times["pil_decode"] = time.perf_counter() - start
+    start = time.perf_counter()
+    small = get_small(img)
+    if small_path is not None:
+        save_small(small, small_path)
+    res = get_detections(img, passes, small, decoders, compare, times, counts)
+    times["barcode_decode"] = time.perf_counter() - start
+    return res
+
+def timed(func, *args):
+    # runs func in the decoding processes and sends the stage times and counters back with the result
+    times = {}
+    counts = {}
+    res = func(*args, times=times, counts=counts)
+    return res, times, counts
+
+def run_timed(decode_pool, func, *args):
+    if decode_pool is None:
+        res, times, counts = timed(func, *args)
+    else:
+        res, times, counts = decode_pool.submit(timed, func, *args).result()
+    for stage, seconds in times.items():
+        METRICS.add_time(stage, seconds)
+    for name, n in counts.items():
+        METRICS.incr(name, n)
+    return res
+
+def run_detection(key, b, decode_pool=None, partial=False, small_res=None):
+    # small_res is the result of the detection on the cached downscaled copy when
+    # it found no EAN, its passes are not run again on the full image
+    passes = CONFIG["passes"]
+    if small_res is not None:
+        passes = [p for p in passes if p not in SMALL_PASSES]
+        if not passes:
+            return small_res
+    small_path = None
+    if IMG_CACHE is not None and CONFIG["cache_small"] and not partial and not IMG_CACHE.has_small(key):
+        small_path = IMG_CACHE.path(key, small=True)
+    res = run_timed(decode_pool, detect_blob, key, b, partial, passes, small_path, CONFIG["decoders"], CONFIG["compare_decoders"])
+    if small_path is not None:
+        IMG_CACHE.register(small_path)
+    if small_res is not None and res is not None:
+        seen = set((det["t"], det["d"]) for det in small_res[0])
+        res = (small_res[0] + [det for det in res[0] if (det["t"], det["d"]) not in seen], res[1])
+    return res
+
+def run_small_detection(key, b, decode_pool=None):
+    return run_timed(decode_pool, detect_small_blob, key, b, CONFIG["passes"], CONFIG["decoders"], CONFIG["compare_decoders"])
+
+def getimgbytes_reduced(key, decode_pool=None):
+    # Fetches the first PARTIAL_BYTES of the image. For progressive jpegs
+    # this is enough to decode a low quality version of the whole image,
+    # if a barcode is found there we stop, otherwise we fetch the rest of the file.
+    # Returns (bytes, detections) where detections is None if they still
+    # have to be computed on the full image.
+    r = gets3range(key, 0, PARTIAL_BYTES-1)
+    if r is None:
+        return None, None
+    head, total = r
+    if len(head) >= total:
+        return head, None
+    if is_progressive_jpeg(head):
+        res = run_detection(key, head, decode_pool, partial=True)
+        if res is not None and res[1]:
+            return head, res
+    rest = gets3range(key, len(head))
+    if rest is None:
+        return None, None
+    return head + rest[0], None
+
+def fetchimg(key, decode_pool=None):
+    """
+    returns (bytes, detections) where detections is None if they still have to be
+    computed. With the small copies cached, detections can also be the result of
+    the small copy without EAN, only the other passes remain to be run on bytes.
+    """
+    small_res = None
+    if IMG_CACHE is not None:
+        if CONFIG["cache_small"]:
+            # a barcode found on the cached downscaled copy spares reading and decoding the full image
+            small = IMG_CACHE.get_small(key)
+            if small is not None:
+                small_res = run_small_detection(key, small, decode_pool)
+                if small_res is not None and small_res[1]:
+                    return None, small_res
+        b = IMG_CACHE.get(key)
+        if b is not None:
+            METRICS.incr("img_cache_hits")
+            return b, small_res
+        METRICS.incr("img_cache_misses")
+    METRICS.incr("images_downloaded")
+    if CONFIG["reduced_fetch"]:
+        b, res = getimgbytes_reduced(key, decode_pool)
+    else:
+        with METRICS.timer("image_fetch"):
+            blob = gets3blob(key)
+        b, res = (blob.getvalue() if blob is not None else None), None
+    if IMG_CACHE is not None and b is not None and res is None:
+        # only full images are cached, not the partial ones
+        IMG_CACHE.put(key, b)
+    return b, res if res is not None else small_res
+
+def fetch_full(key):
+    # full content of an image, from the image cache if possible
+    if IMG_CACHE is not None:
+        b = IMG_CACHE.get(key)
+        if b is not None:
+            METRICS.incr("img_cache_hits")
+            return b
+        METRICS.incr("img_cache_misses")
+    METRICS.incr("images_downloaded")
+    with METRICS.timer("image_fetch"):
+        blob = gets3blob(key)
+    if blob is None:
+        return None
+    b = blob.getvalue()
+    if IMG_CACHE is not None:
+        IMG_CACHE.put(key, b)
+    return b
+
+def detect_fetched(key, fetched, decode_pool=None):
+    # returns (detections, found) or None if the image can't be read
+    b, res = fetched
+    if res is not None and res[1]:
+        return res
+    if b is None:
+        print("error with image "+key)
+        return None
+    # res is the result of the small copy without EAN, if any
+    return run_detection(key, b, decode_pool, small_res=res)
+
+def getdetections(wlname, iglname, fname, decode_pool=None):
+    # returns (detections, found) or None if the image can't be read
+    # the download happens in the calling thread, the decoding can happen in a separate process
+    key = get_s3_folder_prefix(wlname, iglname)+fname
+    return detect_fetched(key, fetchimg(key, decode_pool), decode_pool)
+
+def iter_fetched(wlname, iglname, fnames, decode_pool=None):
+    """
+    yields (fname, key, fetched) in the order of fnames. If prefetch is configured,
+    the next images are downloaded in the background while the current one is decoded.
+    Closing the generator (when an EAN is found) cancels the downloads that haven't started.
+    """
+    prefix = get_s3_folder_prefix(wlname, iglname)
+    if PREFETCH_POOL is None or CONFIG["prefetch"] < 1:
+        for fname in fnames:
+            yield fname, prefix+fname, fetchimg(prefix+fname, decode_pool)
+        return
+    futures = {}
+    try:
+        for i, fname in enumerate(fnames):
+            for nextfname in fnames[i:i+1+CONFIG["prefetch"]]:
+                if nextfname not in futures:
+                    futures[nextfname] = PREFETCH_POOL.submit(fetchimg, prefix+nextfname, decode_pool)
+            yield fname, prefix+fname, futures.pop(fname).result()
+    finally:
+        for future in futures.values():
+            future.cancel()
+
 #
 # db format
 #
@@ -118,27 +489,79 @@ def getimg(wlname, iglname, fname):
 #          - t: EAN13
 #            d: 9787800571282
 #            r: [l, t, w, h]
+#            p: small (detection pass)
 #        
 
 def get_w_infos():
+    # dict-like w -> {"ro": mw, ig: {"n": volume number, "ti": intro pages}}, see catalog.py
+    return catalog.get_w_infos()
+
+def read_rids(args):
+    # each argument is a RID or a file (csv or one RID per line) with the RIDs in the first column
+    res = []
+    for arg in args:
+        if not os.path.isfile(arg):
+            res.append(arg)
+            continue
+        with open(arg, newline='') as csvfile:
+            for row in csv.reader(csvfile):
+                if row and row[0].strip():
+                    res.append(row[0].strip())
+    return res
+
+def get_batch_w_infos(rids, w_infos):
+    """
+    w -> w_info for a list of W, MW or IG RIDs: a MW gives all its works,
+    an IG only this image group in the w_info of its work
+    """
+    cat = catalog.load_catalog()
+    ig_to_w = None
     res = {}
-    with open('mw-w-ig-vn.csv', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            mw = row[0]
-            w = row[1]
-            ig = row[2]
-            vn = int(row[3])
-            ti = int(row[4])
-            if w not in res:
-                res[w] = {}
-            res[w]["ro"] = mw # reproduction of
-            res[w][ig] = {
-                "n": vn,
-                "ti": ti
-            }
+    for rid in rids:
+        if rid in w_infos:
+            res[rid] = w_infos[rid]
+            continue
+        ws = cat.mw_to_ws(rid)
+        if ws:
+            for w in ws:
+                res[w] = w_infos[w]
+            continue
+        if ig_to_w is None:
+            ig_to_w = cat.ig_to_w()
+        if rid in ig_to_w:
+            w = ig_to_w[rid]
+            w_info = res.setdefault(w, {"ro": w_infos[w]["ro"]})
+            w_info[rid] = w_infos[w][rid]
+            continue
+        print("unknown RID "+rid)
     return res
 
+def is_analyzed(db_ig_info):
+    return has_id(db_ig_info) or len(db_ig_info.keys()) > 9
+
+def get_hit(db_ig_info, fnames):
+    # (position label, EANs) of the image where an EAN was found, None if there's none
+    for fname, detections in db_ig_info.items():
+        if fname == "n":
+            continue
+        eans = get_eans(detections)
+        if eans:
+            idx = find_index(fnames, fname)
+            label = position_label(idx, len(fnames)) if idx is not None else None
+            return (label, eans) if label is not None else None
+    return None
+
+def prioritize(flist, ordered_flist, priority, only_priority=False):
+    # puts the images at the positions of priority (see position_label) first
+    first = []
+    for label in priority:
+        idx = label_index(label, len(flist))
+        if idx is not None and flist[idx] not in first:
+            first.append(flist[idx])
+    if only_priority:
+        return first
+    return first + [fname for fname in ordered_flist if fname not in first]
+
 def has_id(db_ig_info):
     # returns True if an id has been found for this ig:
     for fname, detections in db_ig_info.items():
@@ -150,112 +573,648 @@ def has_id(db_ig_info):
     return False
 
 def ordered_imglist(fnames, nb_tip):
-    # tip = tbrc intro pages
-    # most likely are 10 last then 10 first
+    # fnames are the filenames of the image group, only the 10 first and last are accessed
+    return [fnames[i] for i in ordered_positions(len(fnames), nb_tip)]
+
+def get_candidates(mw, ig_info, flist):
+    # returns the filenames to look at, in order, and the probability of a hit
+    # for each of them (None with the heuristic order)
+    if ORDER_MODEL is None:
+        return ordered_imglist(flist, ig_info["ti"]), None
+    strata = get_strata(MW_PUB_PREFIXES.get(mw), len(flist), ig_info["n"])
+    idxs, ps = ORDER_MODEL.order(len(flist), ig_info["ti"], strata)
+    return [flist[i] for i in idxs], ps
+
+def decode_result(d_type, d_data, d_rect, pass_name, to_orig):
+    # result of a decoder backend in the db format
+    data_str = None
+    try:
+        data_str = d_data.decode('ascii')
+    except:
+        print("cannot convert to string: "+str(d_data))
+    resi = {
+        "t": d_type,
+        "d": data_str,
+        "p": pass_name
+    }
+    if d_rect:
+        l, t, w, h = d_rect
+        corners = [to_orig(x, y) for x, y in [(l, t), (l+w, t), (l, t+h), (l+w, t+h)]]
+        ol = round(min(c[0] for c in corners))
+        ot = round(min(c[1] for c in corners))
+        ow = round(max(c[0] for c in corners)) - ol
+        oh = round(max(c[1] for c in corners)) - ot
+        resi["r"] = ",".join([str(ol), str(ot), str(ow), str(oh)])
+    return resi
+
+def add_stat(stats, name, value):
+    if stats is not None:
+        stats[name] = stats.get(name, 0) + value
+
+def count_agreement(eans, counts):
+    # eans is decoder -> set of the EANs it found in an image
+    if not any(eans.values()):
+        return
+    add_stat(counts, "decoders_agree" if len(set(frozenset(e) for e in eans.values())) == 1 else "decoders_disagree", 1)
+    for name, found in eans.items():
+        add_stat(counts, ("decoder_found:" if found else "decoder_missed:")+name, 1)
+
+def decode_pil(pil_img, pass_name, to_orig, decoders=None, compare=False, times=None, counts=None):
+    # to_orig converts a point of pil_img into a point of the original image
+    # the decoders of the chain are tried in order until one of them finds an EAN,
+    # with compare all of them are run and their agreement on the EANs is counted
+    if decoders is None:
+        decoders = DEFAULT_CHAIN
     res = []
-    l = len(fnames)
-    for i in range(1, min(10, l-nb_tip)):
-        res.append(fnames[l-i]["filename"])
-    for i in range(nb_tip, min(10, l)):
-        if fnames[i] not in res:
-            res.append(fnames[i]["filename"])
+    eans = {}
+    for name in decoders:
+        start = time.perf_counter()
+        decoded = BACKENDS[name](pil_img)
+        add_stat(times, "decode:"+name, time.perf_counter() - start)
+        eans[name] = set()
+        for d_type, d_data, d_rect in decoded:
+            resi = decode_result(d_type, d_data, d_rect, pass_name, to_orig)
+            if d_type in EAN_TYPES:
+                eans[name].add(resi["d"])
+            res.append(resi)
+        if eans[name] and not compare:
+            break
+    if compare:
+        count_agreement(eans, counts)
     return res
 
-def get_detections(pil_img):
-    info = decode(pil_img)
-    if info is None:
-        return [], False
+def get_small(pil_img):
+    # grayscale downscaled copy, and the factor to go back to the original size
+    gray = pil_img.convert("L")
+    if max(gray.size) <= SMALL_MAX_SIZE:
+        return gray, 1
+    factor = max(gray.size) / SMALL_MAX_SIZE
+    small = gray.resize((round(gray.size[0] / factor), round(gray.size[1] / factor)), Image.BILINEAR)
+    return small, factor
+
+def rotated_to_orig(angle, rot_size, size, factor):
+    # returns the function converting a point of the image rotated by angle
+    # (counter clockwise, with expand=True) into a point of the original image
+    a = math.radians(angle)
+    cos, sin = math.cos(a), math.sin(a)
+    def to_orig(x, y):
+        u = x - rot_size[0] / 2
+        v = y - rot_size[1] / 2
+        return ((u * cos - v * sin + size[0] / 2) * factor, (u * sin + v * cos + size[1] / 2) * factor)
+    return to_orig
+
+def pass_images(pil_img, pass_name, small):
+    # yields (image, to_orig) for the pass, pil_img is None when only the downscaled copy is available
+    if pil_img is None and pass_name not in SMALL_PASSES:
+        return
+    if pass_name == "small":
+        img, factor = small
+        if factor == 1 and pil_img is not None:
+            # same as the full pass
+            return
+        yield img, lambda x, y: (x * factor, y * factor)
+    elif pass_name == "roi":
+        # bottom right and bottom left quadrants at full resolution,
+        # where barcodes usually are on back covers
+        w, h = pil_img.size
+        for l, t in [(w // 2, h // 2), (0, h // 2)]:
+            crop = pil_img.crop((l, t, l + w - w // 2, h)).convert("L")
+            yield crop, lambda x, y, l=l, t=t: (x + l, y + t)
+    elif pass_name == "full":
+        yield pil_img, lambda x, y: (x, y)
+    elif pass_name == "rot":
+        img, factor = small
+        for angle in ROT_ANGLES:
+            rot = img.rotate(angle, resample=Image.BILINEAR, expand=True, fillcolor=255)
+            yield rot, rotated_to_orig(angle, rot.size, img.size, factor)
+
+def get_detections(pil_img, passes=None, small=None, decoders=None, compare=False, times=None, counts=None):
+    """
+    staged detection: the passes are run in order until one of them finds an EAN:
+       - small: downscaled grayscale copy
+       - roi: bottom quadrants at full resolution
+       - full: the full image at full resolution (what was done originally)
+       - rot: slightly rotated versions of the downscaled copy
+    roi is skipped when full comes after it, full decodes the same pixels again.
+    each detection records the pass that found it in "p"
+    small is the result of get_small(pil_img) if it's already computed
+    decoders is the chain of decoder backends used for each image (see decode_pil)
+    """
+    if passes is None:
+        passes = DEFAULT_PASSES
+    if small is None:
+        small = get_small(pil_img)
     res = []
-    found = False
-    for d in info:
-        data_str = None
-        try:
-            data_str = d.data.decode('ascii')
-        except:
-            print("cannot convert to string: "+str(d.data))
-        resi = {
-            "t": d.type,
-            "d": data_str
-        }
-        if d.type.startswith("EAN"):
-            found = True
-        if d.rect:
-            resi["r"] = ",".join([str(d.rect.left), str(d.rect.top), str(d.rect.width), str(d.rect.height)])
-        res.append(resi)
-    return res, found
-
-
-def process_ig(w, ig, ig_info, db_ig_info, re_run_det=False):
-    if has_id(db_ig_info) or len(db_ig_info.keys()) > 9:
+    seen = set()
+    for i, pass_name in enumerate(passes):
+        if pass_name == "roi" and "full" in passes[i+1:]:
+            continue
+        found = False
+        for img, to_orig in pass_images(pil_img, pass_name, small):
+            for resi in decode_pil(img, pass_name, to_orig, decoders, compare, times, counts):
+                if (resi["t"], resi["d"]) in seen:
+                    continue
+                seen.add((resi["t"], resi["d"]))
+                res.append(resi)
+                if resi["t"] in EAN_TYPES:
+                    found = True
+            if found:
+                return res, True
+    return res, False
+
+
+def process_ig(w, ig, ig_info, db_ig_info, re_run_det=False, decode_pool=None, store=None, mw=None, priority=None, only_priority=False):
+    """
+    priority is an optional list of positions (see position_label) to look at
+    first, or only these ones with only_priority. Returns the hit (see get_hit).
+    """
+    if is_analyzed(db_ig_info):
         # already analyzed
         return
     print("reanalyze "+w+"-"+ig)
-    flist = getImageList(w, ig)
+    flist = getFileNames(w, ig)
     if flist is None:
         print("could not get image list for "+w+"-"+ig)
         return
-    ordered_flist = ordered_imglist(flist, ig_info["ti"])
-    for imgfname in ordered_flist:
-        if imgfname in db_ig_info and not re_run_det:
-            continue
-        img = getimg(w, ig, imgfname)
-        if img is None:
+    ordered_flist, ps = get_candidates(mw, ig_info, flist)
+    # position (from 1) of the images in the candidate order, for the hit rate per
+    # rank, it doesn't depend on the images already in the db or on the priorities
+    ranks = {imgfname: i + 1 for i, imgfname in enumerate(ordered_flist)}
+    if priority:
+        ordered_flist = prioritize(flist, ordered_flist, priority, only_priority)
+        # the probabilities of the learned order don't apply anymore
+        ps = None
+    todo = [imgfname for imgfname in ordered_flist if re_run_det or imgfname not in db_ig_info]
+    nb_fetched = 0
+    fetched_iter = iter_fetched(w, ig, todo, decode_pool)
+    for imgfname, key, fetched in fetched_iter:
+        nb_fetched += 1
+        rank = ranks.get(imgfname)
+        if rank is not None:
+            METRICS.observe("rank_fetched", rank)
+        res = detect_fetched(key, fetched, decode_pool)
+        if res is None:
             continue
-        dets, found = get_detections(img)
+        dets, found = res
         db_ig_info[imgfname] = dets
+        if store is not None:
+            with METRICS.timer("persistence"):
+                store.add_img(w, ig, imgfname, dets)
         if found:
+            if rank is not None:
+                METRICS.observe("rank_hit", rank)
             break
-        
+    fetched_iter.close()
+    METRICS.incr("igs_scanned")
+    METRICS.incr("images_fetched", nb_fetched)
+    METRICS.observe("images_per_ig", nb_fetched)
+    if ps is not None and len(todo) == len(ordered_flist):
+        with ORDER_REPORT_LOCK:
+            ORDER_REPORT["igs"] += 1
+            ORDER_REPORT["expected"] += expected_fetches(ps)
+            ORDER_REPORT["actual"] += nb_fetched
+    return get_hit(db_ig_info, flist)
 
-def process_w(wrid, w_info, db_w_info):
+
+def process_w(wrid, w_info, db_w_info, decode_pool=None, store=None):
+    if store is not None:
+        store.add_w(wrid)
     if wrid == "W3CN5472":
         # there's a tiff in there that makes the process crash
         return
-    for ig, ig_info in w_info.items():
-        if ig == "ro":
-            continue
+    igs = [ig for ig in w_info if ig != "ro"]
+    schedule = None
+    if CONFIG["mv_policy"] != "off" and len(igs) > 1:
+        # multi-volume work, the volumes are scanned in order
+        igs.sort(key=lambda ig: w_info[ig]["n"])
+        schedule = VolumeSchedule(CONFIG["mv_policy"], CONFIG["mv_confirm"])
+    for ig in igs:
+        ig_info = w_info[ig]
         if ig not in db_w_info:
             db_w_info[ig] = {
                 "n": ig_info["n"]
             }
-        process_ig(wrid, ig, ig_info, db_w_info[ig])
+            if store is not None:
+                with METRICS.timer("persistence"):
+                    store.set_ig(wrid, ig, ig_info["n"])
+        if schedule is None:
+            process_ig(wrid, ig, ig_info, db_w_info[ig], decode_pool=decode_pool, store=store, mw=w_info["ro"])
+        else:
+            process_scheduled_ig(wrid, ig, ig_info, db_w_info[ig], schedule, decode_pool, store, w_info["ro"])
+
+def process_scheduled_ig(w, ig, ig_info, db_ig_info, schedule, decode_pool=None, store=None, mw=None):
+    if is_analyzed(db_ig_info):
+        # the schedule still learns from the volumes analyzed in previous runs when their image list is known
+        fnames = IL_STORE.get_head_tail(ig, 10, 10) if IL_STORE is not None else None
+        if fnames is not None:
+            schedule.add(get_hit(db_ig_info, fnames))
+        return
+    priority, only_priority = schedule.next()
+    hit = process_ig(w, ig, ig_info, db_ig_info, decode_pool=decode_pool, store=store, mw=mw, priority=priority, only_priority=only_priority)
+    if only_priority:
+        METRICS.incr("mv_probe_hits" if hit is not None else "mv_probe_misses")
+        if hit is None:
+            if schedule.policy == "stop":
+                # the rest of the volume is not looked at, it will be in a run without the stop policy
+                METRICS.incr("mv_skipped")
+                return
+            hit = process_ig(w, ig, ig_info, db_ig_info, decode_pool=decode_pool, store=store, mw=mw)
+    schedule.add(hit)
+
+def process_stored_w(wrid, w_info, store, decode_pool=None):
+    # the previous results of the work are read from the store, the new ones
+    # are written to it as soon as they are produced
+    db_w_info = store.get_w(wrid)
+    if db_w_info is None:
+        db_w_info = {}
+    process_w(wrid, w_info, db_w_info, decode_pool, store)
+
+def build_manifest(w_infos, nb_workers=1, path="cache/manifest.sqlite"):
+    """
+    writes the S3 prefix and the candidate keys (in the order of ordered_imglist)
+    of all the image groups in a KeyManifest, see key_manifest.py. The image
+    lists that are not in the image list store are downloaded.
+    """
+    igs = [(w, ig) for w in sorted(w_infos) for ig in w_infos[w] if ig != "ro"]
+    def get_entry(w_ig):
+        w, ig = w_ig
+        prefix = get_s3_folder_prefix(w, ig)
+        ti = w_infos[w][ig]["ti"]
+        flist = getFileNames(w, ig)
+        if flist is None:
+            return w, ig, prefix, ti, None, []
+        return w, ig, prefix, ti, len(flist), ordered_imglist(flist, ti)
+    manifest = KeyManifest(path)
+    with ThreadPoolExecutor(max_workers=nb_workers) as pool:
+        manifest.put_many(tqdm(pool.map(get_entry, igs), total=len(igs)))
+    nb_igs, nb_lists, nb_keys = manifest.stats()
+    manifest.close()
+    print("manifest written in %s: %d image groups (%d with an image list), %d candidate keys" % (path, nb_igs, nb_lists, nb_keys))
+
+def get_catalog_fingerprint(ig_info):
+    # what the scan of an image group depends on in the catalog, the volume
+    # number is only recorded with it (see get_delta_w_infos)
+    return "%d" % ig_info["ti"]
 
-def main(wrid = None):
+def get_delta_w_infos(w_infos, store, nb_workers=1):
+    """
+    returns the w_infos restricted to the image groups that are new or changed
+    since they were scanned, by comparing their current fingerprint (catalog
+    fingerprint, ETag of dimensions.json) with the one recorded in the store,
+    and the list of (w, ig) that changed. The image groups analyzed before the
+    fingerprints were recorded get the current one without being scanned again.
+    When only the volume number changed in the catalog, it is updated in the
+    store without scanning the image group again. The fingerprints of the scheduled image groups are put in DELTA_FPS, they
+    are recorded once the image groups are scanned (see process_delta_w).
+    """
+    recorded = store.get_ig_fingerprints()
+    ig_ns = store.get_ig_ns()
+    igs = [(w, ig) for w in sorted(w_infos) for ig in w_infos[w] if ig != "ro"]
+    # one HEAD request per image group
+    with ThreadPoolExecutor(max_workers=max(8, nb_workers)) as pool:
+        etags = list(tqdm(pool.map(lambda w_ig: get_dimensions_etag(*w_ig), igs), total=len(igs)))
+    res = {}
+    changed = []
+    db_w_infos = {}
+    for (w, ig), etag in zip(igs, etags):
+        if etag is None:
+            # no image list, nothing to scan
+            METRICS.incr("delta_missing")
+            continue
+        fp = (get_catalog_fingerprint(w_infos[w][ig]), etag)
+        previous = recorded.get((w, ig))
+        unchanged = previous == fp
+        if previous is None:
+            if w not in db_w_infos:
+                db_w_infos[w] = store.get_w(w) or {}
+            unchanged = is_analyzed(db_w_infos[w].get(ig, {}))
+        if unchanged:
+            n = w_infos[w][ig]["n"]
+            if ig_ns.get((w, ig)) != n:
+                # renumbered volume, the detections stay
+                store.set_ig(w, ig, n)
+                METRICS.incr("delta_renumbered")
+            if previous is None:
+                store.set_ig_fingerprint(w, ig, fp[0], fp[1])
+            METRICS.incr("delta_unchanged" if previous is not None else "delta_adopted")
+            continue
+        if previous is None:
+            METRICS.incr("delta_new")
+        else:
+            METRICS.incr("delta_changed")
+            changed.append((w, ig))
+            if previous[1] != etag:
+                # the image list is outdated
+                IL_STORE.delete(ig)
+                cachepath = Path("cache/il/"+ig+".json.gz")
+                if cachepath.is_file():
+                    cachepath.unlink()
+        w_info = res.setdefault(w, {"ro": w_infos[w]["ro"]})
+        w_info[ig] = w_infos[w][ig]
+        DELTA_FPS[(w, ig)] = fp
+    return res, changed
+
+def process_delta_w(wrid, w_info, store, decode_pool=None):
+    process_stored_w(wrid, w_info, store, decode_pool)
+    db_w_info = store.get_w(wrid) or {}
+    for ig in w_info:
+        if ig == "ro":
+            continue
+        if CONFIG["mv_policy"] == "stop" and not is_analyzed(db_w_info.get(ig, {})):
+            # the volume may have been skipped, it stays scheduled
+            continue
+        store.set_ig_fingerprint(wrid, ig, *DELTA_FPS[(wrid, ig)])
+
+def get_eans(detections):
+    return set(det["d"] for det in detections if det["t"] in EAN_TYPES)
+
+def verify_blob(key, b, detections, passes=None, decoders=None, times=None, counts=None):
+    """
+    can run in the decoding processes. Decodes the regions of the stored
+    detections (rect plus a margin) of an image and returns (detections, status):
+       - "crop": the regions have the same EANs as the stored detections, which are returned
+       - "full": they don't but the detection on the full image finds the same EANs
+       - "changed": the detection on the full image finds other EANs, the new detections are returned
+       - "error": the image can't be read, the stored detections are returned
+    """
+    if times is None:
+        times = {}
+    start = time.perf_counter()
+    try:
+        img = Image.open(io.BytesIO(b))
+        img.load()
+    except:
+        print("error with image "+key)
+        return detections, "error"
+    times["pil_decode"] = time.perf_counter() - start
+    start = time.perf_counter()
+    stored = get_eans(detections)
+    found = set()
+    rects = [det["r"] for det in detections if "r" in det]
+    for r in rects:
+        l, t, w, h = [int(x) for x in r.split(",")]
+        margin = round(max(w, h) * VERIFY_MARGIN)
+        box = (max(0, l - margin), max(0, t - margin), min(img.size[0], l + w + margin), min(img.size[1], t + h + margin))
+        crop = img.crop(box).convert("L")
+        for resi in decode_pil(crop, "crop", lambda x, y: (x + box[0], y + box[1]), decoders, False, times, counts):
+            if resi["t"] in EAN_TYPES:
+                found.add(resi["d"])
+    times["barcode_decode"] = time.perf_counter() - start
+    if rects and found == stored:
+        return detections, "crop"
+    # mismatch (or nothing to crop), escalation to the normal detection on the full image
+    start = time.perf_counter()
+    res = get_detections(img, passes, None, decoders, False, times, counts)[0]
+    times["barcode_decode"] += time.perf_counter() - start
+    if get_eans(res) == stored:
+        return detections, "full"
+    return res, "changed"
+
+def verify_w(wrid, w_info, store, decode_pool=None):
+    """
+    re-validates the stored detections of a work, images without detections
+    are not looked at again
+    """
+    db_w_info = store.get_w(wrid)
+    if db_w_info is None:
+        return
+    for ig, db_ig_info in db_w_info.items():
+        prefix = get_s3_folder_prefix(wrid, ig)
+        for fname, detections in db_ig_info.items():
+            if fname == "n" or not detections:
+                continue
+            b = fetch_full(prefix+fname)
+            if b is None:
+                METRICS.incr("verify_missing")
+                continue
+            res, status = run_timed(decode_pool, verify_blob, prefix+fname, b, detections, CONFIG["passes"], CONFIG["decoders"])
+            METRICS.incr("verify_"+status)
+            if status == "changed":
+                tqdm.write("%s-%s %s: %s -> %s" % (wrid, ig, fname, ",".join(sorted(d or "" for d in get_eans(detections))), ",".join(sorted(d or "" for d in get_eans(res)))))
+                with METRICS.timer("persistence"):
+                    store.add_img(wrid, ig, fname, res)
+
+def process_ws_parallel(wrids, w_infos, store, nb_workers, nb_decode_workers, process=process_stored_w):
+    # Each work is handled by a thread that downloads the images, the
+    # barcode decoding is sent to a pool of processes. Image groups are still
+    # processed image by image so that we stop at the first EAN found.
+    # The decoding processes are started by a fork server and not forked from
+    # this process, where a download thread can hold a lock (stdout for
+    # instance) when a process is started.
+    mp_context = multiprocessing.get_context("forkserver")
+    with ThreadPoolExecutor(max_workers=nb_workers) as fetch_pool, ProcessPoolExecutor(max_workers=nb_decode_workers, mp_context=mp_context) as decode_pool:
+        futures = [fetch_pool.submit(process, w, w_infos[w], store, decode_pool) for w in wrids]
+        for future in tqdm(futures):
+            future.result()
+
+def train_page_order(w_infos, store, path="page_order_model.json"):
+    # learns the page order from the image groups in the store, see page_order.py
+    pubs = get_mw_pub_prefixes()
+    def records():
+        for w, db_w_info in tqdm(store.iter_ws()):
+            if w not in w_infos:
+                continue
+            for ig, db_ig_info in db_w_info.items():
+                if ig not in w_infos[w]:
+                    continue
+                ig_info = w_infos[w][ig]
+                fnames = IL_STORE.get_head_tail(ig, 10, 10)
+                if fnames is None:
+                    continue
+                hit = None
+                for fname, detections in db_ig_info.items():
+                    if fname != "n" and any(det["t"] == "EAN13" for det in detections):
+                        hit = fname
+                        break
+                nb_fetched = len([fname for fname in db_ig_info if fname != "n"])
+                strata = get_strata(pubs.get(w_infos[w]["ro"]), len(fnames), ig_info["n"])
+                yield strata, fnames, ig_info["ti"], hit, nb_fetched
+    model, report = train(records())
+    model.save(path)
+    print("page order model written in "+path)
+    print_report(report)
+
+def open_store(path="db.sqlite", keep=None):
+    # keep is an optional function telling which works to import from db.yml
+    store = ScanStore(path)
+    if store.is_empty() and Path("db.yml").is_file():
+        # first run with the store, we import the results of previous runs
+        print("importing db.yml into "+path)
+        store.import_yaml("db.yml", keep)
+    return store
+
+def get_shard_store_path(shard, nb_shards):
+    return "db-shard-%d-of-%d.sqlite" % (shard, nb_shards)
+
+def get_shard_metrics_path(shard, nb_shards):
+    return "metrics-shard-%d-of-%d.json" % (shard, nb_shards)
+
+def merge_shards(paths, path="db.sqlite"):
+    store = open_store(path)
+    for shard_path in paths:
+        print("merging "+shard_path)
+        store.merge(shard_path)
+    return store
+
+def main(wrid = None, nb_workers = 1, nb_decode_workers = None, export_only = False, import_il = False, ordering = "heuristic", train_ordering = False, shard = None, merge = None, metrics_path = None, verify = False, batch = None, rescan = False, delta = False, manifest = False):
+    """
+    shard is an optional (shard number, nb of shards) tuple: only the works of
+    the shard are processed and the results go in their own store, the stores
+    are combined with merge (a list of shard store paths).
+    metrics_path defaults to metrics.json, or metrics-shard-i-of-N.json for a
+    shard so that shards run from the same directory don't overwrite each other
+    ("" = not written).
+    verify re-validates the stored detections (see verify_w) instead of scanning.
+    batch is an optional list of W, MW or IG RIDs (see get_batch_w_infos), only
+    these are processed, and with rescan their previous detections are removed first.
+    delta only scans the image groups that are new or changed since their last
+    scan (see get_delta_w_infos), the detections of the changed ones are removed first.
+    manifest only builds cache/manifest.sqlite (see build_manifest).
+    """
+    global PREFETCH_POOL, IL_STORE, ORDER_MODEL, MW_PUB_PREFIXES
+    if S3 is None:
+        init_s3(max_pool_connections=max(10, nb_workers * (CONFIG["prefetch"] + 1)))
+    if CONFIG["prefetch"] > 0:
+        # each worker has its current image and prefetch next ones pending, the current
+        # one must not wait behind the speculative downloads of the other workers
+        PREFETCH_POOL = ThreadPoolExecutor(max_workers=nb_workers * (CONFIG["prefetch"] + 1))
     w_infos = get_w_infos()    
-    # this currently only generates db.yml
+    if batch is not None:
+        w_infos = get_batch_w_infos(batch, w_infos)
+        print("batch of %d works, %d image groups" % (len(w_infos), sum(len(w_info) - 1 for w_info in w_infos.values())))
     # create image list cache dir
     cachedir = Path("cache/il/")
     if not cachedir.is_dir():
         os.makedirs(str(cachedir))
-    # read db
-    db = {}
+    IL_STORE = ImageListStore("cache/il.sqlite")
+    if import_il:
+        print("imported %d image lists from cache/il/" % IL_STORE.import_dir("cache/il/"))
+    if ordering == "learned":
+        ORDER_MODEL = PageOrderModel.load("page_order_model.json")
+        MW_PUB_PREFIXES = get_mw_pub_prefixes()
+    if manifest:
+        build_manifest(w_infos, nb_workers)
+        return
     if wrid is not None:
-        if wrid not in db:
-            db[wrid] = {}
+        db = {wrid: {}}
         process_w(wrid, w_infos[wrid], db[wrid])
         print(yaml.dump(db[wrid], Dumper=yaml_dumper))
         return
-    if Path("db.yml").is_file():
-        with open("db.yml", 'r') as stream:
-            db = yaml.load(stream, Loader=yaml_loader)
-    i = 0
-    for w in tqdm(sorted(w_infos)):
-        if w not in db:
-            db[w] = {}
-        process_w(w, w_infos[w], db[w])
-        i += 1
-        if i>= 200:
-            try:
-                with open("db.yml", 'w') as stream:
-                    yaml.dump(db, stream, Dumper=yaml_dumper)
-                i = 0
-            except KeyboardInterrupt:
-                # poor man's atomicity
-                time.sleep(2)
-                raise
+    if merge:
+        store = merge_shards(merge)
+        print("writing db.yml")
+        store.export_yaml("db.yml")
+        store.close()
+        return
+    if shard is not None:
+        shard_nb, nb_shards = shard
+        if metrics_path is None:
+            metrics_path = get_shard_metrics_path(shard_nb, nb_shards)
+        ws = sorted(w for w in w_infos if get_shard(w, nb_shards) == shard_nb)
+        store = open_store(get_shard_store_path(shard_nb, nb_shards), lambda w: get_shard(w, nb_shards) == shard_nb)
+        print("shard %d/%d: %d works" % (shard_nb, nb_shards, len(ws)))
+    else:
+        if metrics_path is None:
+            metrics_path = "metrics.json"
+        ws = sorted(w_infos)
+        store = open_store()
+    if train_ordering:
+        train_page_order(w_infos, store)
+        store.close()
+        return
+    if rescan and batch is not None and not export_only:
+        for w in ws:
+            store.add_w(w)
+            for ig in w_infos[w]:
+                if ig != "ro":
+                    store.clear_ig(w, ig)
+    process = verify_w if verify else process_stored_w
+    if delta and not verify and not export_only:
+        w_infos, changed = get_delta_w_infos({w: w_infos[w] for w in ws}, store, nb_workers)
+        ws = sorted(w_infos)
+        for w, ig in changed:
+            store.clear_ig(w, ig)
+            store.set_ig(w, ig, w_infos[w][ig]["n"])
+        print("delta: %d works, %d image groups to scan (%d changed)" % (len(ws), len(DELTA_FPS), len(changed)))
+        process = process_delta_w
+    if not export_only:
+        if nb_workers > 1:
+            process_ws_parallel(ws, w_infos, store, nb_workers, nb_decode_workers, process)
+        else:
+            for w in tqdm(ws):
+                process(w, w_infos[w], store)
+    if ORDER_REPORT["igs"]:
+        print("learned page order on %d image groups: %.2f images fetched expected, %.2f actual" % (ORDER_REPORT["igs"], ORDER_REPORT["expected"] / ORDER_REPORT["igs"], ORDER_REPORT["actual"] / ORDER_REPORT["igs"]))
+    if not export_only:
+        print(METRICS.summary())
+        if metrics_path:
+            METRICS.write(metrics_path)
+    if shard is not None:
+        # the partition is merged into db.sqlite / db.yml with --merge
+        store.close()
+        return
     print("writing db.yml")
-    if i > 0:
-        with open("db.yml", 'w') as stream:
-            yaml.dump(db, stream, Dumper=yaml_dumper)
+    store.export_yaml("db.yml")
+    store.close()
 
-main()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="detect barcodes in the images of BDRC volumes and record them in db.sqlite / db.yml")
+    parser.add_argument("wrid", nargs="?", help="only process this work and print the result")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="number of threads downloading images (1 = serial mode)")
+    parser.add_argument("--decode-workers", type=int, default=None, help="number of processes decoding barcodes with -j 2 or more (defaults to the number of cores), with -j 1 the barcodes are decoded in the main process")
+    parser.add_argument("--export", action="store_true", help="only export db.sqlite to db.yml")
+    parser.add_argument("--reduced-fetch", action="store_true", help="first try to detect barcodes in the beginning of progressive jpegs, only download the rest of the image when nothing is found")
+    parser.add_argument("--passes", default=",".join(DEFAULT_PASSES), help="comma separated list of detection passes, among "+", ".join(DETECTION_PASSES)+" (roi is skipped when full comes after it, rot is only run when asked for)")
+    parser.add_argument("--prefetch", type=int, default=0, help="number of images of an image group downloaded in advance while the current one is decoded")
+    parser.add_argument("--s3-dir", help="read the S3 keys from this local directory instead of the bucket")
+    parser.add_argument("--s3-latency", type=float, default=0, help="artificial latency in seconds added to each request when using --s3-dir")
+    parser.add_argument("--img-cache-gb", type=float, default=0, help="keep the downloaded images in cache/img/ within this size budget (in GB, 0 = no image cache)")
+    parser.add_argument("--cache-small", action="store_true", help="also keep a downscaled grayscale copy of the images in the image cache")
+    parser.add_argument("--import-il", action="store_true", help="import the cache/il/ files into cache/il.sqlite before scanning")
+    parser.add_argument("--ordering", choices=["heuristic", "learned"], default="heuristic", help="order in which the images of an image group are looked at, learned uses page_order_model.json")
+    parser.add_argument("--train-ordering", action="store_true", help="learn page_order_model.json from the image groups in db.sqlite")
+    parser.add_argument("--shard", help="i/N: only process the works of shard i (from 0) out of N, the results go in db-shard-i-of-N.sqlite")
+    parser.add_argument("--merge", nargs="+", metavar="SHARD_DB", help="merge these shard stores into db.sqlite and export db.yml")
+    parser.add_argument("--decoders", default=",".join(DEFAULT_CHAIN), help="comma separated chain of barcode decoders tried in order until one finds an EAN, among "+", ".join(BACKENDS)+" (the zbar profiles are defined in decoders.py, zxing requires pyzxing)")
+    parser.add_argument("--compare-decoders", action="store_true", help="run all the decoders of the chain on each image and count how often they agree")
+    parser.add_argument("--verify", action="store_true", help="re-validate the stored detections by decoding the stored barcode regions, the full images are only decoded again when they don't match")
+    parser.add_argument("--batch", nargs="+", metavar="RID_OR_FILE", help="only process these W, MW or IG RIDs, or the RIDs in the first column of these files (ex: analysis/malformed_toreview.csv), the results are added to db.sqlite / db.yml")
+    parser.add_argument("--rescan", action="store_true", help="with --batch, remove the previous detections of the image groups and scan them again")
+    parser.add_argument("--delta", action="store_true", help="only scan the image groups that are new or changed (intro pages in the catalog, dimensions.json on S3) since their last scan, a new volume number is updated without scanning again, the first delta run records the fingerprints of the image groups already analyzed")
+    parser.add_argument("--mv-policy", choices=["off", "reorder", "probe", "stop"], default="off", help="scheduling of the volumes of multi-volume works: off = independent volumes, reorder = the positions where barcodes were found in the previous volumes are looked at first, probe = once --mv-confirm volumes had the same EAN at the same position, only that position is looked at first, stop = only that position is looked at")
+    parser.add_argument("--mv-confirm", type=int, default=3, help="number of volumes with the same EAN at the same position before --mv-policy probe or stop applies")
+    parser.add_argument("--build-manifest", action="store_true", help="only write the S3 prefix and candidate image keys of all the image groups in cache/manifest.sqlite (missing image lists are downloaded), see key_manifest.py to export them")
+    parser.add_argument("--rdf-dump", help="read the catalog from this local RDF dump instead of mw-w-ig-vn.csv and mw-isbn.csv (requires pyoxigraph)")
+    parser.add_argument("--metrics", default=None, help="file where the timings and counters of the scan are written (default: metrics.json, metrics-shard-i-of-N.json with --shard, empty = not written)")
+    args = parser.parse_args()
+    if args.rdf_dump is not None:
+        catalog.use_dump(args.rdf_dump)
+    if args.img_cache_gb > 0:
+        IMG_CACHE = ImageCache("cache/img/", int(args.img_cache_gb * 1024**3))
+    CONFIG["cache_small"] = args.cache_small
+    CONFIG["reduced_fetch"] = args.reduced_fetch
+    CONFIG["passes"] = args.passes.split(",")
+    CONFIG["prefetch"] = args.prefetch
+    CONFIG["mv_policy"] = args.mv_policy
+    CONFIG["mv_confirm"] = args.mv_confirm
+    CONFIG["decoders"] = args.decoders.split(",")
+    CONFIG["compare_decoders"] = args.compare_decoders
+    try:
+        check_chain(CONFIG["decoders"])
+    except ValueError as e:
+        parser.error(str(e))
+    if args.s3_dir is not None:
+        init_s3(args.s3_dir, args.s3_latency)
+    if args.rescan and not args.batch:
+        parser.error("--rescan only applies to the image groups of --batch")
+    batch = read_rids(args.batch) if args.batch else None
+    shard = None
+    if args.shard is not None:
+        try:
+            shard_nb, nb_shards = args.shard.split("/")
+            shard = (int(shard_nb), int(nb_shards))
+        except ValueError:
+            parser.error("--shard must be i/N")
+        if shard[1] < 1 or not 0 <= shard[0] < shard[1]:
+            parser.error("--shard i/N needs N >= 1 and 0 <= i < N")
+    main(args.wrid, args.workers, args.decode_workers, args.export, args.import_il, args.ordering, args.train_ordering, shard, args.merge, args.metrics, args.verify, batch, args.rescan, args.delta, args.build_manifest)
@@ -0,0 +1,93 @@
+import yaml
+from scan_store import ScanStore
+
+# use yaml.CSafeLoader / if available but don't crash if it isn't
+try:
+    yaml_loader = yaml.CSafeLoader
+except (ImportError, AttributeError):
+    yaml_loader = yaml.SafeLoader
+
+RESOLVER = yaml.resolver.Resolver()
+CONSTRUCTOR = yaml.constructor.SafeConstructor()
+
+#
+# Reads db.yml (or db.sqlite) one work at a time, so that the memory used
+# doesn't depend on the size of the db and the analysis can start right away.
+# db.yml is read through the yaml events and only the current work is built.
+#
+
+def _scalar(event):
+    tag = event.tag
+    if tag is None or tag == '!':
+        tag = RESOLVER.resolve(yaml.ScalarNode, event.value, event.implicit)
+    node = yaml.ScalarNode(tag, event.value, style=event.style)
+    if tag in CONSTRUCTOR.yaml_constructors:
+        return CONSTRUCTOR.yaml_constructors[tag](CONSTRUCTOR, node)
+    return event.value
+
+def _build(event, events, anchors):
+    if isinstance(event, yaml.AliasEvent):
+        return anchors[event.anchor]
+    if isinstance(event, yaml.ScalarEvent):
+        res = _scalar(event)
+    elif isinstance(event, yaml.SequenceStartEvent):
+        res = []
+        if event.anchor is not None:
+            anchors[event.anchor] = res
+        for subevent in events:
+            if isinstance(subevent, yaml.SequenceEndEvent):
+                break
+            res.append(_build(subevent, events, anchors))
+        return res
+    elif isinstance(event, yaml.MappingStartEvent):
+        res = {}
+        if event.anchor is not None:
+            anchors[event.anchor] = res
+        for subevent in events:
+            if isinstance(subevent, yaml.MappingEndEvent):
+                break
+            key = _build(subevent, events, anchors)
+            res[key] = _build(next(events), events, anchors)
+        return res
+    else:
+        raise ValueError("unexpected yaml event: "+str(event))
+    if event.anchor is not None:
+        anchors[event.anchor] = res
+    return res
+
+def iter_works(path="db.yml"):
+    """
+    yields (w, w_dbinfo) for each work of the db, in the order of the file
+    """
+    if path.endswith(".sqlite"):
+        store = ScanStore(path)
+        yield from store.iter_ws()
+        store.close()
+        return
+    with open(path, 'r') as stream:
+        events = yaml.parse(stream, Loader=yaml_loader)
+        for event in events:
+            if isinstance(event, yaml.MappingStartEvent):
+                break
+        else:
+            # empty file
+            return
+        # objects referenced several times in the document (rare in the db)
+        anchors = {}
+        for event in events:
+            if isinstance(event, yaml.MappingEndEvent):
+                return
+            w = _scalar(event)
+            yield w, _build(next(events), events, anchors)
+
+def iter_records(path="db.yml"):
+    """
+    yields (w, ig, fname, detections) for each image of the db, the volume
+    number of the image groups (key "n") is not included
+    """
+    for w, w_dbinfo in iter_works(path):
+        for ig, iginfo in w_dbinfo.items():
+            for fname, detections in iginfo.items():
+                if fname == "n":
+                    continue
+                yield w, ig, fname, detections
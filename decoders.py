@@ -0,0 +1,176 @@
+import os
+import tempfile
+from ctypes import cast, c_void_p
+from pyzbar import pyzbar
+from pyzbar.pyzbar import decode as zbar_decode, ZBarSymbol
+from pyzbar.wrapper import ZBarConfig, zbar_image_scanner_set_config, zbar_image_set_format, zbar_image_set_size, zbar_image_set_data, zbar_scan_image
+
+# pyzxing (which needs java) is optional, the zxing backend is only available when it's installed
+try:
+    from pyzxing import BarCodeReader
+except ImportError:
+    BarCodeReader = None
+
+#
+# Barcode decoder backends. A backend is a function taking a PIL image and
+# returning a list of (type, data, rect) where type is in the zbar naming
+# (EAN13, QRCODE, etc.), data is bytes and rect is (left, top, width, height)
+# or None. get_detections in create_db.py tries the backends of a chain in
+# order and stops at the first one finding an EAN.
+#
+
+# types of the barcodes that stop the detection
+EAN_TYPES = ["EAN13", "EAN8"]
+
+#
+# zbar profiles: the symbologies zbar looks for (None = zbar's default, all
+# of them), the scan density (zbar scans every line by default, a density
+# of 2 scans every other line) and the binarization of the image before the
+# scan. The ISBN10 / ISBN13 zbar symbologies are never enabled: zbar would then
+# report the ISBN barcodes as ISBN13 instead of EAN13, which is what db.yml records.
+# EAN5 is the price add-on next to some EAN-13, see zbar_results.
+#
+PROFILES = {
+    "zbar": {"symbols": None, "density": None, "binarize": False},
+    "zbar-ean": {"symbols": [ZBarSymbol.EAN13, ZBarSymbol.EAN8, ZBarSymbol.EAN5], "density": None, "binarize": False},
+    "zbar-ean-fast": {"symbols": [ZBarSymbol.EAN13, ZBarSymbol.EAN5], "density": 2, "binarize": False},
+    "zbar-ean-bin": {"symbols": [ZBarSymbol.EAN13, ZBarSymbol.EAN5], "density": None, "binarize": True}
+}
+
+# zxing format -> zbar type
+ZXING_TYPES = {
+    "EAN_13": "EAN13",
+    "EAN_8": "EAN8",
+    "UPC_A": "UPCA",
+    "UPC_E": "UPCE",
+    "QR_CODE": "QRCODE",
+    "CODE_128": "CODE128",
+    "CODE_39": "CODE39",
+    "CODE_93": "CODE93",
+    "PDF_417": "PDF417",
+    "DATA_MATRIX": "DATAMATRIX"
+}
+
+def zbar_results(decoded):
+    res = []
+    for d in decoded:
+        rect = (d.rect.left, d.rect.top, d.rect.width, d.rect.height) if d.rect else None
+        if d.type == "COMPOSITE" and len(d.data) in (15, 18) and d.data.isdigit():
+            # with EAN5 (or EAN2) enabled, zbar merges an EAN-13 and its add-on in a
+            # single COMPOSITE symbol with the digits of both, they are split back
+            res.append(("EAN13", d.data[:13], rect))
+            res.append(("EAN5" if len(d.data) == 18 else "EAN2", d.data[13:], rect))
+            continue
+        res.append((d.type, d.data, rect))
+    return res
+
+def zbar_scan(pil_img, symbols=None, density=None):
+    """
+    same as pyzbar.decode, with the scan density that pyzbar doesn't expose
+    (this uses the private functions of pyzbar.pyzbar)
+    """
+    if not density:
+        return zbar_decode(pil_img, symbols=symbols)
+    pixels, width, height = pyzbar._pixel_data(pil_img)
+    with pyzbar._image_scanner() as scanner:
+        if symbols:
+            for symbol in set(ZBarSymbol).difference(symbols):
+                zbar_image_scanner_set_config(scanner, symbol, ZBarConfig.CFG_ENABLE, 0)
+            for symbol in symbols:
+                zbar_image_scanner_set_config(scanner, symbol, ZBarConfig.CFG_ENABLE, 1)
+        zbar_image_scanner_set_config(scanner, ZBarSymbol.NONE, ZBarConfig.CFG_X_DENSITY, density)
+        zbar_image_scanner_set_config(scanner, ZBarSymbol.NONE, ZBarConfig.CFG_Y_DENSITY, density)
+        with pyzbar._image() as img:
+            zbar_image_set_format(img, pyzbar._FOURCC['L800'])
+            zbar_image_set_size(img, width, height)
+            zbar_image_set_data(img, cast(pixels, c_void_p), len(pixels), None)
+            if zbar_scan_image(scanner, img) < 0:
+                raise pyzbar.PyZbarError('Unsupported image format')
+            return list(pyzbar._decode_symbols(pyzbar._symbols_for_image(img)))
+
+def otsu_threshold(gray):
+    # threshold maximizing the variance between the two classes of the histogram
+    hist = gray.histogram()
+    total = sum(hist)
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    sum_b = 0
+    w_b = 0
+    best = 0
+    threshold = 128
+    for i, h in enumerate(hist):
+        w_b += h
+        if w_b == 0:
+            continue
+        w_f = total - w_b
+        if w_f == 0:
+            break
+        sum_b += i * h
+        m_b = sum_b / w_b
+        m_f = (sum_all - sum_b) / w_f
+        between = w_b * w_f * (m_b - m_f) ** 2
+        if between > best:
+            best = between
+            threshold = i
+    return threshold
+
+def binarize(pil_img):
+    gray = pil_img.convert("L")
+    threshold = otsu_threshold(gray)
+    return gray.point(lambda v: 255 if v > threshold else 0)
+
+def decode_zbar_profile(profile, pil_img):
+    if profile["binarize"]:
+        pil_img = binarize(pil_img)
+    return zbar_results(zbar_scan(pil_img, profile["symbols"], profile["density"]))
+
+# one reader per process, it starts a java process for each decoding
+ZXING_READER = None
+
+def decode_zxing(pil_img):
+    global ZXING_READER
+    if ZXING_READER is None:
+        ZXING_READER = BarCodeReader()
+    # pyzxing reads files
+    fd, path = tempfile.mkstemp(suffix=".png")
+    os.close(fd)
+    try:
+        pil_img.save(path, format="PNG")
+        results = ZXING_READER.decode(path)
+    finally:
+        os.remove(path)
+    res = []
+    for r in results or []:
+        if "parsed" not in r:
+            # no barcode found
+            continue
+        fmt = r.get("format", b"")
+        if isinstance(fmt, bytes):
+            fmt = fmt.decode('ascii')
+        data = r["parsed"]
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        rect = None
+        points = r.get("points")
+        if points:
+            xs = [p[0] for p in points]
+            ys = [p[1] for p in points]
+            rect = (round(min(xs)), round(min(ys)), round(max(xs) - min(xs)), round(max(ys) - min(ys)))
+        res.append((ZXING_TYPES.get(fmt, fmt.replace("_", "")), data, rect))
+    return res
+
+BACKENDS = {
+    "zxing": decode_zxing
+}
+for name, profile in PROFILES.items():
+    BACKENDS[name] = lambda pil_img, profile=profile: decode_zbar_profile(profile, pil_img)
+
+# decoders used by default, what was used before the backends could be chosen
+DEFAULT_CHAIN = ["zbar"]
+
+def check_chain(chain):
+    # raises a ValueError if a backend of the chain doesn't exist or isn't available
+    for name in chain:
+        if name not in BACKENDS:
+            raise ValueError("unknown decoder "+name+", available decoders: "+", ".join(BACKENDS))
+        if name == "zxing" and BarCodeReader is None:
+            raise ValueError("the zxing decoder requires pyzxing")
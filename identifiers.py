@@ -0,0 +1,229 @@
+import re
+import csv
+import time
+from functools import lru_cache
+import pyisbn
+
+# numpy is only needed for the batch functions, fall back on the per string path if it isn't available
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#
+# Identifiers (isbn, issn, ean) shared by create_db.py, analyze-db.py and summarize_reviewed.py
+#
+
+def normalize_isbn(isbn):
+    return isbn.upper().replace("-", "").replace(" ", "")
+
+def normalize_from_db(isbn):
+    if '(' in isbn:
+        isbn = isbn[:isbn.find('(')]
+    if '/' in isbn:
+        isbn = isbn[:isbn.find('/')]
+    return normalize_isbn(isbn)
+
+@lru_cache(maxsize=None)
+def well_formed(isbn, allow_issn=False):
+    # assumes isbn is normalized
+    if allow_issn:
+        match = re.search(r'^(\d{9}[0-9X]|\d{7}[0-9X]|\d{13})$', isbn)
+    else:
+        match = re.search(r'^(\d{9}[0-9X]|\d{13})$', isbn)
+    return True if match else False
+
+def valid(isbn):
+    # assumes isbn is normalized
+    match = re.search(r'^(\d{9}|\d{12})(\d|X)$', isbn)
+    if not match:
+        return False
+    if len(isbn) == 10:
+        return sum((10 - i) * (10 if d == 'X' else int(d)) for i, d in enumerate(isbn)) % 11 == 0
+    if match.group(2) == 'X':
+        return False
+    return sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(isbn)) % 10 == 0
+
+@lru_cache(maxsize=None)
+def looksgood(isbn):
+    if not well_formed(isbn):
+        return False
+    if not isbn.startswith("978") and not isbn.startswith("979"):
+        return False
+    return pyisbn.validate(isbn)
+
+def guess_id_type(num):
+    if len(num) == 8:
+        return "issn"
+    if len(num) == 2:
+        return "in"
+    if len(num) != 13:
+        # case of len(num) == 10 (most common) or anything weird
+        return "isbn"
+    if num.startswith("977"):
+        return "issn"
+    if num.startswith("978") or num.startswith("979"):
+        return "isbn"
+    return "ean"
+
+def equivalence_key(isbn):
+    # an isbn-10 and an isbn-13 are equivalent when they have the same key
+    if len(isbn) == 10:
+        return isbn[:9]
+    if len(isbn) == 13:
+        return isbn[3:12]
+    return None
+
+def isbn10_to_13(isbn):
+    digits = "978"+isbn[:9]
+    check = (10 - sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(digits)) % 10) % 10
+    return digits+str(check)
+
+def isbn13_to_10(isbn):
+    digits = isbn[3:12]
+    check = (11 - sum((10 - i) * int(d) for i, d in enumerate(digits)) % 11) % 11
+    return digits+("X" if check == 10 else str(check))
+
+@lru_cache(maxsize=None)
+def canonical_isbn(isbn):
+    """
+    canonical 13 digits form of an isbn, computed once per string:
+    isbn-10 are converted to isbn-13, other strings that are not
+    well formed isbns are their own key
+    """
+    if not well_formed(isbn):
+        return isbn
+    if len(isbn) == 13:
+        return isbn
+    return isbn10_to_13(isbn)
+
+def classify_one(s):
+    """
+    per string version of classify(), returns (normalized, type, valid, isbn13, isbn10)
+    """
+    n = normalize_isbn(s)
+    t = guess_id_type(n)
+    ok = False
+    isbn13 = None
+    isbn10 = None
+    if len(n) == 8 and well_formed(n, allow_issn=True):
+        ok = sum((8 - i) * (10 if d == 'X' else int(d)) for i, d in enumerate(n)) % 11 == 0
+    elif len(n) in [10, 13] and well_formed(n):
+        ok = valid(n)
+    if t == "isbn" and well_formed(n):
+        if len(n) == 10:
+            isbn10 = n
+            isbn13 = isbn10_to_13(n)
+        elif n.startswith("978"):
+            isbn13 = n
+            isbn10 = isbn13_to_10(n)
+        else:
+            isbn13 = n
+    return n, t, ok, isbn13, isbn10
+
+def classify(strings):
+    """
+    batch classification of candidate identifiers. Returns a dict of columns:
+       - normalized: list of normalized strings
+       - type: list of isbn / issn / ean / in (see guess_id_type)
+       - valid: booleans, checksum validity (isbn-10, ean-13, issn)
+       - isbn13, isbn10: lists of the isbn in both forms when they exist, None otherwise
+    The checksums and conversions are computed on a matrix of digits with numpy.
+    """
+    if np is None:
+        rows = [classify_one(s) for s in strings]
+        return {
+            "normalized": [r[0] for r in rows],
+            "type": [r[1] for r in rows],
+            "valid": [r[2] for r in rows],
+            "isbn13": [r[3] for r in rows],
+            "isbn10": [r[4] for r in rows]
+        }
+    normalized = [normalize_isbn(s) for s in strings]
+    nb = len(normalized)
+    lengths = np.fromiter((len(n) for n in normalized), dtype=np.int32, count=nb)
+    # one row of 13 ascii characters per string, padded with spaces
+    raw = "".join(n[:13].ljust(13) for n in normalized).encode('ascii', 'replace')
+    chars = np.frombuffer(raw, dtype=np.uint8).reshape(nb, 13)
+    isdigit = (chars >= 48) & (chars <= 57)
+    isx = chars == 88
+    digits = np.where(isdigit, chars.astype(np.int32) - 48, 0)
+    digits = np.where(isx, 10, digits)
+    # well formedness: all digits except the check character which can be an X (not for ean-13)
+    alldigits = np.cumprod(isdigit, axis=1).sum(axis=1)
+    lastok = isdigit | isx
+    is13 = (lengths == 13) & (alldigits >= 13)
+    is10 = (lengths == 10) & (alldigits >= 9) & lastok[:, 9]
+    is8 = (lengths == 8) & (alldigits >= 7) & lastok[:, 7]
+    ean_weights = np.array([1, 3] * 6 + [1], dtype=np.int32)
+    ean_ok = (digits * ean_weights).sum(axis=1) % 10 == 0
+    isbn10_ok = (digits[:, :10] * np.arange(10, 0, -1)).sum(axis=1) % 11 == 0
+    issn_ok = (digits[:, :8] * np.arange(8, 0, -1)).sum(axis=1) % 11 == 0
+    valid_col = np.where(is13, ean_ok, np.where(is10, isbn10_ok, np.where(is8, issn_ok, False)))
+    # types, following guess_id_type
+    prefix = digits[:, 0] * 100 + digits[:, 1] * 10 + digits[:, 2]
+    prefix_is_digits = isdigit[:, :3].all(axis=1)
+    types = np.full(nb, "isbn", dtype=object)
+    types[(lengths == 13) & prefix_is_digits & (prefix == 977)] = "issn"
+    types[(lengths == 13) & ~(prefix_is_digits & ((prefix == 977) | (prefix == 978) | (prefix == 979)))] = "ean"
+    types[lengths == 2] = "in"
+    types[lengths == 8] = "issn"
+    # conversions
+    core = digits[:, :9]
+    core13 = digits[:, 3:12]
+    check13 = (10 - ((np.concatenate([np.tile([9, 7, 8], (nb, 1)), core], axis=1) * ean_weights[:12]).sum(axis=1) % 10)) % 10
+    check10 = (11 - (core13 * np.arange(10, 1, -1)).sum(axis=1) % 11) % 11
+    isbn_type = types == "isbn"
+    from10 = is10 & isbn_type
+    from13 = is13 & isbn_type
+    from978 = from13 & (prefix == 978)
+    isbn13 = [None] * nb
+    isbn10 = [None] * nb
+    for i in np.nonzero(from10)[0]:
+        isbn10[i] = normalized[i]
+        isbn13[i] = "978"+normalized[i][:9]+str(check13[i])
+    for i in np.nonzero(from13)[0]:
+        isbn13[i] = normalized[i]
+    for i in np.nonzero(from978)[0]:
+        isbn10[i] = normalized[i][3:12]+("X" if check10[i] == 10 else str(check10[i]))
+    return {
+        "normalized": normalized,
+        "type": list(types),
+        "valid": [bool(v) for v in valid_col],
+        "isbn13": isbn13,
+        "isbn10": isbn10
+    }
+
+def get_benchmark_strings(mw_isbn_path='mw-isbn.csv', db_path='db.yml'):
+    res = []
+    with open(mw_isbn_path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        for row in reader:
+            for orig_isbn in re.split(',|;', row[1]):
+                res.append(normalize_from_db(orig_isbn))
+    try:
+        from db_stream import iter_records
+        for w, ig, fname, detections in iter_records(db_path):
+            for det in detections:
+                if det["t"] == "EAN13" and det["d"]:
+                    res.append(det["d"])
+    except FileNotFoundError:
+        pass
+    return res
+
+def benchmark():
+    strings = get_benchmark_strings()
+    start = time.perf_counter()
+    rows = [classify_one(s) for s in strings]
+    per_string = time.perf_counter() - start
+    start = time.perf_counter()
+    cols = classify(strings)
+    batch = time.perf_counter() - start
+    mismatches = 0
+    for i, row in enumerate(rows):
+        if row != (cols["normalized"][i], cols["type"][i], cols["valid"][i], cols["isbn13"][i], cols["isbn10"][i]):
+            mismatches += 1
+    print("%d identifiers: %.3fs per string, %.3fs batch%s, %d mismatches" % (len(strings), per_string, batch, "" if np is not None else " (numpy not available)", mismatches))
+
+if __name__ == "__main__":
+    benchmark()
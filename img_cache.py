@@ -0,0 +1,92 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+class ImageCache:
+    """
+    On disk cache of the images downloaded from S3, keyed by their S3 key.
+    Files are stored as root/<2 first chars>/<sha1 of the key> (and .small.png
+    for the optional downscaled version). The total size is kept under max_bytes
+    by removing the least recently used files, the last access being recorded
+    in the mtime of the files so that it survives between runs.
+    """
+
+    def __init__(self, root="cache/img/", max_bytes=10 * 1024**3):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # path -> size, from least to most recently used
+        self.entries = OrderedDict()
+        self.total = 0
+        if not self.root.is_dir():
+            os.makedirs(str(self.root))
+        existing = []
+        for dirpath, dirnames, filenames in os.walk(str(self.root)):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                st = os.stat(path)
+                existing.append((st.st_mtime, path, st.st_size))
+        for mtime, path, size in sorted(existing):
+            self.entries[path] = size
+            self.total += size
+
+    def path(self, key, small=False):
+        h = hashlib.sha1(str.encode(key)).hexdigest()
+        return str(self.root / h[:2] / (h + (".small.png" if small else "")))
+
+    def _get(self, path):
+        with self.lock:
+            if path not in self.entries:
+                return None
+            self.entries.move_to_end(path)
+        try:
+            os.utime(path)
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.total -= self.entries.pop(path, 0)
+            return None
+
+    def get(self, key):
+        return self._get(self.path(key))
+
+    def get_small(self, key):
+        return self._get(self.path(key, small=True))
+
+    def has_small(self, key):
+        with self.lock:
+            return self.path(key, small=True) in self.entries
+
+    def put(self, key, b):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = path+".%d.tmp" % threading.get_ident()
+        with open(tmppath, 'wb') as f:
+            f.write(b)
+        os.replace(tmppath, path)
+        self.register(path)
+
+    def register(self, path):
+        # records a file written in the cache directory (possibly by another process)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.total += size - self.entries.pop(path, 0)
+            self.entries[path] = size
+            self._evict()
+
+    def _evict(self):
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            path, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import gzip
+import json
+import os
+from pathlib import Path
+from tqdm import tqdm
+
+class HeadTail:
+    """
+    the first and last filenames of an image group, indexable like the full
+    list of filenames as long as only these positions are accessed
+    """
+
+    def __init__(self, head, tail, total):
+        self.head = head
+        self.tail = tail
+        self.total = total
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.total
+        if 0 <= i < len(self.head):
+            return self.head[i]
+        if self.total - len(self.tail) <= i < self.total:
+            return self.tail[i - self.total + len(self.tail)]
+        raise IndexError("position %d of %d not in head or tail" % (i, self.total))
+
+class ImageListStore:
+    """
+    Image lists of all the image groups in a single sqlite file (cache/il.sqlite),
+    replacing the cache/il/<IG>.json.gz files. Only the sequence of filenames is
+    kept, indexed by position so that the beginning and end of a list can be read
+    without loading the whole list.
+    """
+
+    def __init__(self, path="cache/il.sqlite"):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS igs (ig TEXT PRIMARY KEY, n INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS fnames (ig TEXT, idx INTEGER, fname TEXT, PRIMARY KEY (ig, idx)) WITHOUT ROWID")
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _put(self, ig, fnames):
+        self.conn.execute("DELETE FROM fnames WHERE ig = ?", (ig,))
+        self.conn.execute("INSERT OR REPLACE INTO igs VALUES (?, ?)", (ig, len(fnames)))
+        self.conn.executemany("INSERT INTO fnames VALUES (?, ?, ?)", [(ig, i, fname) for i, fname in enumerate(fnames)])
+
+    def put(self, ig, fnames):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self._put(ig, fnames)
+            self.conn.execute("COMMIT")
+
+    def delete(self, ig):
+        # the list is fetched again the next time it's needed
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM fnames WHERE ig = ?", (ig,))
+            self.conn.execute("DELETE FROM igs WHERE ig = ?", (ig,))
+            self.conn.execute("COMMIT")
+
+    def get_total(self, ig):
+        with self.lock:
+            row = self.conn.execute("SELECT n FROM igs WHERE ig = ?", (ig,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_fnames(self, ig):
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM igs WHERE ig = ?", (ig,)).fetchone() is None:
+                return None
+            return [row[0] for row in self.conn.execute("SELECT fname FROM fnames WHERE ig = ? ORDER BY idx", (ig,))]
+
+    def get_head_tail(self, ig, nhead=10, ntail=10):
+        """
+        returns a HeadTail with the nhead first and ntail last filenames, or
+        None if the image group is not in the store
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT n FROM igs WHERE ig = ?", (ig,)).fetchone()
+            if row is None:
+                return None
+            total = row[0]
+            head = [r[0] for r in self.conn.execute("SELECT fname FROM fnames WHERE ig = ? AND idx < ? ORDER BY idx", (ig, min(nhead, total)))]
+            tailstart = max(total - ntail, len(head))
+            tail = [r[0] for r in self.conn.execute("SELECT fname FROM fnames WHERE ig = ? AND idx >= ? ORDER BY idx", (ig, tailstart))]
+        return HeadTail(head, tail, total)
+
+    def import_dir(self, dirpath="cache/il/"):
+        """
+        imports the cache/il/<IG>.json.gz files, returns the number of image groups imported
+        """
+        paths = sorted(Path(dirpath).glob("*.json.gz"))
+        nb = 0
+        with self.lock:
+            self.conn.execute("BEGIN")
+            for path in tqdm(paths):
+                ig = path.name[:-len(".json.gz")]
+                try:
+                    with gzip.open(str(path), 'r') as gzipfile:
+                        data = json.loads(gzipfile.read())
+                except:
+                    tqdm.write("can't read "+str(path))
+                    continue
+                self._put(ig, [f["filename"] for f in data])
+                nb += 1
+            self.conn.execute("COMMIT")
+        return nb
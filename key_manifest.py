@@ -0,0 +1,106 @@
+import os
+import sys
+import sqlite3
+import argparse
+import threading
+
+class KeyManifest:
+    """
+    S3 prefix and candidate image keys of every image group of the catalog, in a
+    single sqlite file (cache/manifest.sqlite), built by create_db.py --build-manifest.
+    The candidates are the filenames in the order of ordered_imglist, the keys are
+    prefix + filename. total is the number of images of the image group, with ti
+    (tbrc intro pages) it tells if the candidates are still valid. Image groups
+    without an image list only have their prefix (total is NULL).
+    """
+
+    def __init__(self, path="cache/manifest.sqlite"):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS igs (ig TEXT PRIMARY KEY, w TEXT, prefix TEXT, ti INTEGER, total INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS candidates (ig TEXT, rank INTEGER, fname TEXT, PRIMARY KEY (ig, rank)) WITHOUT ROWID")
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def put_many(self, entries):
+        # entries is an iterable of (w, ig, prefix, ti, total, candidates)
+        with self.lock:
+            self.conn.execute("BEGIN")
+            for w, ig, prefix, ti, total, candidates in entries:
+                self.conn.execute("DELETE FROM candidates WHERE ig = ?", (ig,))
+                self.conn.execute("INSERT OR REPLACE INTO igs VALUES (?, ?, ?, ?, ?)", (ig, w, prefix, ti, total))
+                self.conn.executemany("INSERT INTO candidates VALUES (?, ?, ?)", [(ig, i, fname) for i, fname in enumerate(candidates)])
+            self.conn.execute("COMMIT")
+
+    def get_candidate_keys(self, ig, ti=None, total=None):
+        """
+        returns the candidate keys of the image group in order, None if it's not
+        in the manifest or if ti / total are given and don't match the manifest
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT prefix, ti, total FROM igs WHERE ig = ?", (ig,)).fetchone()
+            if row is None or row[2] is None:
+                return None
+            prefix, m_ti, m_total = row
+            if (ti is not None and ti != m_ti) or (total is not None and total != m_total):
+                return None
+            return [prefix+r[0] for r in self.conn.execute("SELECT fname FROM candidates WHERE ig = ? ORDER BY rank", (ig,))]
+
+    def iter_prefixes(self):
+        # (w, ig, prefix) in the order of the w and ig
+        with self.lock:
+            rows = self.conn.execute("SELECT w, ig, prefix FROM igs ORDER BY w, ig").fetchall()
+        yield from rows
+
+    def iter_keys(self, max_rank=None):
+        """
+        yields the candidate keys of all the image groups, the max_rank first
+        candidates of each image group if max_rank is given
+        """
+        with self.lock:
+            query = "SELECT prefix, fname FROM igs JOIN candidates USING (ig)"
+            params = ()
+            if max_rank is not None:
+                query += " WHERE rank < ?"
+                params = (max_rank,)
+            cursor = self.conn.execute(query+" ORDER BY w, ig, rank", params)
+        # the whole catalog has millions of keys, they are read by batches
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(10000)
+            if not rows:
+                return
+            for prefix, fname in rows:
+                yield prefix+fname
+
+    def stats(self):
+        with self.lock:
+            nb_igs, nb_lists = self.conn.execute("SELECT COUNT(*), COUNT(total) FROM igs").fetchone()
+            nb_keys = self.conn.execute("SELECT COUNT(*) FROM candidates").fetchone()[0]
+        return nb_igs, nb_lists, nb_keys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export the key manifest built by create_db.py --build-manifest as a plain list, one per line")
+    parser.add_argument("output", help="output file (- for stdout)")
+    parser.add_argument("--manifest", default="cache/manifest.sqlite")
+    parser.add_argument("--prefixes", action="store_true", help="export the prefixes of the image groups instead of the image keys")
+    parser.add_argument("--max-rank", type=int, default=None, help="only export the N first candidates of each image group")
+    parser.add_argument("--bucket", help="write s3://BUCKET/key URLs instead of the keys")
+    args = parser.parse_args()
+    manifest = KeyManifest(args.manifest)
+    if args.prefixes:
+        keys = (prefix for w, ig, prefix in manifest.iter_prefixes())
+    else:
+        keys = manifest.iter_keys(args.max_rank)
+    url_prefix = "s3://%s/" % args.bucket if args.bucket else ""
+    out = sys.stdout if args.output == "-" else open(args.output, 'w')
+    for key in keys:
+        out.write(url_prefix+key+"\n")
+    if out is not sys.stdout:
+        out.close()
+    manifest.close()
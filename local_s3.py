@@ -0,0 +1,61 @@
+import io
+import os
+import time
+import shutil
+from pathlib import Path
+import botocore.exceptions
+
+class DirS3Client:
+    """
+    Minimal stand-in for the boto3 s3 client, serving the keys from files
+    in a local directory (the bucket is ignored, the key is the relative path).
+    An artificial latency can be added to each request to simulate the round
+    trips to S3 when benchmarking offline.
+    Only the methods used by create_db.py are implemented.
+    """
+
+    def __init__(self, root, latency=0):
+        self.root = Path(root)
+        self.latency = latency
+
+    def _path(self, op, key):
+        if self.latency:
+            time.sleep(self.latency)
+        path = self.root / key
+        if not path.is_file():
+            raise botocore.exceptions.ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, op)
+        return path
+
+    def download_fileobj(self, Bucket, Key, Fileobj):
+        path = self._path('HeadObject', Key)
+        with open(str(path), 'rb') as f:
+            shutil.copyfileobj(f, Fileobj)
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = self._path('GetObject', Key)
+        total = os.path.getsize(str(path))
+        start, end = 0, total - 1
+        if Range is not None:
+            # only "bytes=start-" and "bytes=start-end" are supported
+            rstart, rend = Range[len("bytes="):].split('-')
+            start = int(rstart)
+            if rend:
+                end = min(int(rend), total - 1)
+            if start >= total:
+                raise botocore.exceptions.ClientError({'Error': {'Code': 'InvalidRange', 'Message': 'Invalid Range'}}, 'GetObject')
+        with open(str(path), 'rb') as f:
+            f.seek(start)
+            b = f.read(end - start + 1)
+        return {
+            'Body': io.BytesIO(b),
+            'ContentLength': len(b),
+            'ContentRange': 'bytes %d-%d/%d' % (start, end, total)
+        }
+
+    def head_object(self, Bucket, Key):
+        path = self._path('HeadObject', Key)
+        st = os.stat(str(path))
+        return {
+            'ContentLength': st.st_size,
+            'ETag': '"%x-%x"' % (int(st.st_mtime_ns), st.st_size)
+        }
@@ -0,0 +1,86 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+class Metrics:
+    """
+    Counters and timers of the scan pipeline, shared by the download threads.
+    Timers are per stage (total time and number of calls), counters are plain
+    integers and histograms count values (ex: number of images fetched per image group).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def add_time(self, stage, seconds, nb=1):
+        with self.lock:
+            timer = self.timers.setdefault(stage, [0, 0.0])
+            timer[0] += nb
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {})
+            histogram[value] = histogram.get(value, 0) + 1
+
+    def ratio(self, hits, misses):
+        total = self.counters.get(hits, 0) + self.counters.get(misses, 0)
+        return self.counters.get(hits, 0) / total if total else None
+
+    def to_dict(self):
+        with self.lock:
+            res = {
+                "wall_time": time.time() - self.start,
+                "timers": {stage: {"calls": nb, "seconds": seconds} for stage, (nb, seconds) in self.timers.items()},
+                "counters": dict(self.counters),
+                "histograms": {name: {str(k): v for k, v in sorted(h.items())} for name, h in self.histograms.items()}
+            }
+        # hit rate for each rank in the list of candidate images
+        tries = self.histograms.get("rank_fetched", {})
+        hits = self.histograms.get("rank_hit", {})
+        res["hit_rate_per_rank"] = {str(rank): hits.get(rank, 0) / nb for rank, nb in sorted(tries.items())}
+        res["cache_hit_ratios"] = {
+            "images": self.ratio("img_cache_hits", "img_cache_misses"),
+            "image_lists": self.ratio("il_cache_hits", "il_cache_misses")
+        }
+        return res
+
+    def write(self, path="metrics.json"):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def summary(self):
+        d = self.to_dict()
+        lines = ["%.1fs total" % d["wall_time"]]
+        for stage, timer in sorted(d["timers"].items(), key=lambda x: -x[1]["seconds"]):
+            lines.append("  %-16s %8.1fs  %7d calls  %.3fs/call" % (stage, timer["seconds"], timer["calls"], timer["seconds"] / timer["calls"] if timer["calls"] else 0))
+        for name, value in sorted(d["counters"].items()):
+            lines.append("  %-16s %d" % (name, value))
+        nb_igs = self.counters.get("igs_scanned", 0)
+        if nb_igs:
+            lines.append("  %.2f images fetched per image group" % (self.counters.get("images_fetched", 0) / nb_igs))
+        for name, ratio in d["cache_hit_ratios"].items():
+            if ratio is not None:
+                lines.append("  %s cache hit ratio: %.1f%%" % (name, 100 * ratio))
+        if d["hit_rate_per_rank"]:
+            lines.append("  hit rate per rank: "+", ".join("%s: %.1f%%" % (rank, 100 * rate) for rank, rate in d["hit_rate_per_rank"].items()))
+        return "\n".join(lines)
+
+METRICS = Metrics()
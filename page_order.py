@@ -0,0 +1,232 @@
+import json
+import re
+from collections import defaultdict
+from identifiers import normalize_from_db
+import catalog
+
+# weight of the less specific level when smoothing the probabilities of a stratum
+ALPHA = 5
+
+def ordered_positions(l, nb_tip):
+    # indexes of the images to look at in an image group of l images
+    # tip = tbrc intro pages
+    # most likely are 10 last then 10 first
+    res = []
+    for i in range(1, min(10, l-nb_tip)):
+        res.append(l-i)
+    for i in range(nb_tip, min(10, l)):
+        if i not in res:
+            res.append(i)
+    return res
+
+def position_label(idx, l):
+    # "t1" is the last image, "h0" the first one
+    if idx >= l - 9:
+        return "t%d" % (l - idx)
+    if idx < 10:
+        return "h%d" % idx
+    return None
+
+def label_index(label, l):
+    # inverse of position_label, None if the position doesn't exist in an image group of l images
+    idx = l - int(label[1:]) if label[0] == "t" else int(label[1:])
+    return idx if 0 <= idx < l else None
+
+def size_bucket(l):
+    for b in [20, 100, 300, 600]:
+        if l < b:
+            return "<%d" % b
+    return ">=600"
+
+def vol_bucket(vn):
+    if vn <= 1:
+        return "1"
+    if vn < 10:
+        return "2-9"
+    return "10+"
+
+def get_pub_prefix(isbn_str):
+    # rough publisher prefix: first 4 digits of the isbn without the 978 prefix
+    isbn = normalize_from_db(re.split(',|;', isbn_str)[0])
+    if len(isbn) == 10:
+        return isbn[:4]
+    if len(isbn) == 13:
+        return isbn[3:7]
+    return None
+
+def get_mw_pub_prefixes():
+    res = {}
+    for mw, isbn_str in catalog.load_catalog().iter_isbn_rows():
+        prefix = get_pub_prefix(isbn_str)
+        if prefix is not None:
+            res[mw] = prefix
+    return res
+
+def get_strata(pub, l, vn):
+    # from the most specific to the most general
+    res = []
+    if pub is not None:
+        res.append("p:%s|s:%s|v:%s" % (pub, size_bucket(l), vol_bucket(vn)))
+        res.append("p:%s" % pub)
+    res.append("s:%s|v:%s" % (size_bucket(l), vol_bucket(vn)))
+    res.append("all")
+    return res
+
+def expected_fetches(ps):
+    # ps are the probabilities of a hit at each rank, we stop at the first hit
+    e = 0
+    for rank, p in enumerate(ps, 1):
+        e += rank * p
+    return e + len(ps) * max(0, 1 - sum(ps))
+
+class PageOrderModel:
+    """
+    Learns where the barcodes were found in the image groups already scanned,
+    per stratum (publisher prefix of the catalog isbn, number of images, volume
+    number), and orders the candidate images of ordered_positions by decreasing
+    probability of having the barcode. Each stratum is smoothed towards the
+    more general one, and the original heuristic order is the prior, so that
+    strata with few image groups stay close to it.
+    """
+
+    def __init__(self, counts=None, igs=None):
+        # stratum -> position -> nb of image groups where the barcode was there
+        self.counts = defaultdict(lambda: defaultdict(int))
+        # stratum -> nb of image groups
+        self.igs = defaultdict(int)
+        for stratum, poscounts in (counts or {}).items():
+            self.counts[stratum].update(poscounts)
+        self.igs.update(igs or {})
+
+    def add(self, strata, pos):
+        # pos is None when no barcode was found
+        for stratum in strata:
+            self.igs[stratum] += 1
+            if pos is not None:
+                self.counts[stratum][pos] += 1
+
+    def probabilities(self, strata, positions):
+        # prior: hits in half of the image groups, decreasing with the heuristic rank
+        weights = [1 / (rank + 2) for rank in range(len(positions))]
+        p = {pos: 0.5 * w / sum(weights) for pos, w in zip(positions, weights)}
+        for stratum in reversed(strata):
+            n = self.igs.get(stratum, 0)
+            if n == 0:
+                continue
+            c = self.counts.get(stratum, {})
+            p = {pos: (c.get(pos, 0) + ALPHA * p[pos]) / (n + ALPHA) for pos in positions}
+        return p
+
+    def order(self, l, nb_tip, strata):
+        """
+        returns the indexes to look at and the probability of a hit for each of them
+        """
+        idxs = ordered_positions(l, nb_tip)
+        labels = [position_label(idx, l) for idx in idxs]
+        p = self.probabilities(strata, labels)
+        ranked = sorted(range(len(idxs)), key=lambda r: (-p[labels[r]], r))
+        return [idxs[r] for r in ranked], [p[labels[r]] for r in ranked]
+
+    def save(self, path="page_order_model.json"):
+        with open(path, 'w') as f:
+            json.dump({"counts": self.counts, "igs": self.igs}, f, indent=1, sort_keys=True)
+
+    @staticmethod
+    def load(path="page_order_model.json"):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return PageOrderModel(data["counts"], data["igs"])
+
+class VolumeSchedule:
+    """
+    Pages looked at in the volumes of a multi-volume work, scanned by increasing
+    volume number: the positions where a barcode was found in the previous volumes
+    are tried first. Once the same position gave a common EAN in the last `confirm`
+    volumes (same isbn for all the volumes, or isbn of the set next to the isbn of
+    the volume), the policy decides what is looked at in the next volumes:
+       - reorder: the same as before, only the order changes
+       - probe: only this position first, the rest of the candidates if nothing is found there
+       - stop: only this position
+    """
+
+    def __init__(self, policy="reorder", confirm=3):
+        self.policy = policy
+        self.confirm = confirm
+        # positions of the hits, most recent first
+        self.positions = []
+        # (position, EANs) of the last consecutive volumes with a hit
+        self.streak = []
+
+    def add(self, hit):
+        # hit is (position label, set of EANs), or None if no barcode was found in the volume
+        if hit is None:
+            self.streak = []
+            return
+        label, eans = hit
+        if label in self.positions:
+            self.positions.remove(label)
+        self.positions.insert(0, label)
+        self.streak = (self.streak + [hit])[-self.confirm:]
+
+    def confirmed(self):
+        if len(self.streak) < self.confirm:
+            return False
+        labels = set(label for label, eans in self.streak)
+        common = set.intersection(*[eans for label, eans in self.streak])
+        return len(labels) == 1 and len(common) > 0
+
+    def next(self):
+        # returns (positions to look at first, True if only these positions should be looked at)
+        if self.policy in ["probe", "stop"] and self.confirmed():
+            return [self.streak[-1][0]], True
+        return list(self.positions), False
+
+def find_index(fnames, fname):
+    # fnames can be a HeadTail, where only some positions are accessible
+    if hasattr(fnames, "head"):
+        if fname in fnames.head:
+            return fnames.head.index(fname)
+        if fname in fnames.tail:
+            return len(fnames) - len(fnames.tail) + fnames.tail.index(fname)
+        return None
+    return fnames.index(fname) if fname in fnames else None
+
+def train(records):
+    """
+    records are (strata, fnames, nb_tip, hit_fname, nb_fetched) for each scanned image group,
+    hit_fname being None if no barcode was found.
+    Returns the model and an evaluation of the number of images fetched per image group
+    (in sample: the model is evaluated on the image groups it was trained on).
+    """
+    model = PageOrderModel()
+    records = list(records)
+    for strata, fnames, nb_tip, hit_fname, nb_fetched in records:
+        pos = None
+        if hit_fname is not None:
+            idx = find_index(fnames, hit_fname)
+            if idx is not None:
+                pos = position_label(idx, len(fnames))
+        model.add(strata, pos)
+    report = {"igs": 0, "hits": 0, "actual": 0, "expected": 0, "heuristic_rank": 0, "learned_rank": 0}
+    for strata, fnames, nb_tip, hit_fname, nb_fetched in records:
+        l = len(fnames)
+        idxs, ps = model.order(l, nb_tip, strata)
+        report["igs"] += 1
+        report["actual"] += nb_fetched
+        report["expected"] += expected_fetches(ps)
+        heuristic = ordered_positions(l, nb_tip)
+        idx = find_index(fnames, hit_fname) if hit_fname is not None else None
+        if idx is not None and idx in heuristic:
+            report["hits"] += 1
+            report["heuristic_rank"] += heuristic.index(idx) + 1
+            report["learned_rank"] += idxs.index(idx) + 1
+    return model, report
+
+def print_report(report):
+    if not report["igs"]:
+        print("no image group")
+        return
+    print("%d image groups, %d with a barcode in the candidate images" % (report["igs"], report["hits"]))
+    print("fetches per image group: %.2f actual, %.2f expected with the learned order" % (report["actual"] / report["igs"], report["expected"] / report["igs"]))
+    if report["hits"]:
+        print("fetches until the barcode: %.2f with the heuristic order, %.2f with the learned order" % (report["heuristic_rank"] / report["hits"], report["learned_rank"] / report["hits"]))
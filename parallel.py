@@ -0,0 +1,63 @@
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# number of items sent to a worker process at once
+PARTITION_SIZE = 200
+
+def map_partitions(func, items, nb_workers=1, partition_size=PARTITION_SIZE):
+    """
+    yields (item, result) for each item of items, in the order of items. func takes
+    a list of items (a partition) and returns the list of their results, it must be
+    picklable (a module level function or a functools.partial of one).
+
+    With nb_workers > 1 the partitions are processed in worker processes, with at most
+    two partitions per worker waiting so that items can be a stream over the whole db.
+    The results come back in the order of the items, so merging them gives exactly
+    the same thing as the serial run.
+    """
+    items = iter(items)
+    if nb_workers <= 1:
+        for item in items:
+            yield item, func([item])[0]
+        return
+    with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+        pending = deque()
+        while True:
+            partition = list(islice(items, partition_size))
+            if not partition:
+                break
+            pending.append((partition, executor.submit(func, partition)))
+            if len(pending) > 2 * nb_workers:
+                partition, future = pending.popleft()
+                yield from zip(partition, future.result())
+        while pending:
+            partition, future = pending.popleft()
+            yield from zip(partition, future.result())
+
+def check_parallel(main, nb_workers, *args):
+    """
+    runs main(*args, nb_workers=..., out_dir=...) serially and with nb_workers
+    processes, in two temporary directories, and compares its results and the
+    output files byte for byte, returns True when they are identical. Both runs
+    must be in the same process: the order of some outputs comes from python
+    sets and can change with the hash seed.
+    """
+    with tempfile.TemporaryDirectory() as serial_dir, tempfile.TemporaryDirectory() as parallel_dir:
+        serial_res = main(*args, nb_workers=1, out_dir=serial_dir)
+        parallel_res = main(*args, nb_workers=nb_workers, out_dir=parallel_dir)
+        ok = serial_res == parallel_res
+        if not ok:
+            print("different results")
+        for fname in sorted(os.listdir(serial_dir)):
+            with open(os.path.join(serial_dir, fname), 'rb') as f:
+                serial_content = f.read()
+            with open(os.path.join(parallel_dir, fname), 'rb') as f:
+                parallel_content = f.read()
+            if serial_content != parallel_content:
+                print("different "+fname)
+                ok = False
+    print("parallel run identical to the serial run" if ok else "parallel run differs from the serial run")
+    return ok
@@ -0,0 +1,153 @@
+import os
+import csv
+import gzip
+import shutil
+import pickle
+import hashlib
+import argparse
+from catalog import Catalog, CACHE_VERSION, file_signature
+
+# pyoxigraph is optional, it is only needed to read the catalog from an RDF dump
+try:
+    from pyoxigraph import Store, RdfFormat
+except ImportError:
+    Store = None
+
+#
+# Catalog read from a local RDF dump of the BDRC database (N-Triples, Turtle,
+# N-Quads, TriG, optionally gzipped) instead of mw-w-ig-vn.csv and mw-isbn.csv:
+# the dump is loaded in an on-disk oxigraph store and get_w.rq / get_isbn.rq
+# are evaluated on it, their rows go directly in the Catalog.
+#
+# The store is kept in cache/rdf_store/<checksum of the dump>/ and the catalog
+# in cache/catalog_rdf.pickle, keyed by the checksum of the dump and of the
+# queries: a dump downloaded again without changes is not loaded again.
+#
+
+PREFIXES = """
+PREFIX : <http://purl.bdrc.io/ontology/core/>
+PREFIX bdo: <http://purl.bdrc.io/ontology/core/>
+PREFIX bdr: <http://purl.bdrc.io/resource/>
+PREFIX adm: <http://purl.bdrc.io/ontology/admin/>
+PREFIX bda: <http://purl.bdrc.io/admindata/>
+PREFIX bf: <http://id.loc.gov/ontologies/bibframe/>
+PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+"""
+
+QUERY_DIR = os.path.dirname(os.path.abspath(__file__))
+QUERIES = ["get_w.rq", "get_isbn.rq"]
+
+def file_checksum(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def read_query(name):
+    with open(os.path.join(QUERY_DIR, name)) as f:
+        return PREFIXES + f.read()
+
+def queries_checksum():
+    h = hashlib.sha1()
+    for name in QUERIES:
+        h.update(read_query(name).encode('utf-8'))
+    return h.hexdigest()
+
+def local_name(term):
+    # bdr:MW22084 -> MW22084
+    return term.value.rsplit("/", 1)[-1]
+
+def load_store(dump_path, checksum, store_dir):
+    """
+    returns the oxigraph store of the dump, loading it if it's not already in store_dir
+    (the stores of the previous dumps are removed)
+    """
+    path = os.path.join(store_dir, checksum)
+    # written once the dump is fully loaded
+    marker = path+".loaded"
+    if os.path.isfile(marker):
+        return Store(path)
+    if os.path.isdir(store_dir):
+        for fname in os.listdir(store_dir):
+            fpath = os.path.join(store_dir, fname)
+            if os.path.isdir(fpath):
+                shutil.rmtree(fpath)
+            else:
+                os.remove(fpath)
+    os.makedirs(store_dir, exist_ok=True)
+    print("loading %s in %s" % (dump_path, path))
+    store = Store(path)
+    if dump_path.endswith(".gz"):
+        with gzip.open(dump_path, 'rb') as f:
+            store.bulk_load(f, format=RdfFormat.from_extension(dump_path[:-3].rsplit(".", 1)[-1]))
+    else:
+        store.bulk_load(path=dump_path)
+    store.flush()
+    with open(marker, 'w') as f:
+        f.write(dump_path)
+    return store
+
+def read_dump(dump_path, checksum, store_dir="cache/rdf_store"):
+    if Store is None:
+        raise ImportError("reading the catalog from an RDF dump requires pyoxigraph")
+    store = load_store(dump_path, checksum, store_dir)
+    catalog = Catalog()
+    # the named graphs of the dump are queried as a single graph
+    for sol in store.query(read_query("get_w.rq"), use_default_graph_as_union=True):
+        catalog.add_w_row(local_name(sol["mw"]), local_name(sol["w"]), local_name(sol["ig"]), int(sol["vn"].value), int(sol["vpti"].value))
+    for sol in store.query(read_query("get_isbn.rq"), use_default_graph_as_union=True):
+        catalog.add_isbn_row(local_name(sol["mw"]), sol["isbn"].value)
+    return catalog
+
+def load_dump_catalog(dump_path, cache_path='cache/catalog_rdf.pickle', store_dir='cache/rdf_store'):
+    """
+    returns the catalog of the dump, from the pickled cache if the dump and the
+    queries haven't changed. The checksum of the dump is only computed when the
+    size or modification time of the file changed.
+    """
+    q_checksum = queries_checksum()
+    signature = (CACHE_VERSION, file_signature(dump_path), q_checksum)
+    cached = None
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = pickle.load(f)
+        except Exception:
+            pass
+    if cached is not None and cached[0] == signature:
+        return cached[2]
+    checksum = file_checksum(dump_path)
+    key = (CACHE_VERSION, checksum, q_checksum)
+    if cached is not None and cached[1] == key:
+        catalog = cached[2]
+    else:
+        catalog = read_dump(dump_path, checksum, store_dir)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmppath = cache_path+".tmp"
+    with open(tmppath, 'wb') as f:
+        pickle.dump((signature, key, catalog), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmppath, cache_path)
+    return catalog
+
+def export_csvs(catalog, w_path='mw-w-ig-vn.csv', isbn_path='mw-isbn.csv'):
+    # same files as the manual exports of get_w.rq and get_isbn.rq
+    with open(w_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        for row in range(len(catalog.w)):
+            writer.writerow([catalog.rids[catalog.mw[row]], catalog.rids[catalog.w[row]], catalog.rids[catalog.ig[row]], catalog.vn[row], catalog.ti[row]])
+    with open(isbn_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        for mw, isbn_str in catalog.iter_isbn_rows():
+            writer.writerow([mw, isbn_str])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="load the catalog from a local RDF dump (requires pyoxigraph)")
+    parser.add_argument("dump", help="RDF dump (.nt, .ttl, .nq, .trig, optionally .gz)")
+    parser.add_argument("--export", action="store_true", help="also write mw-w-ig-vn.csv and mw-isbn.csv")
+    args = parser.parse_args()
+    catalog = load_dump_catalog(args.dump)
+    print("%d works, %d mws, %d isbn rows" % (len(catalog.w_rows), len(catalog.mw_rows), len(catalog.isbn_str)))
+    if args.export:
+        export_csvs(catalog)
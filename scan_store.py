@@ -0,0 +1,171 @@
+import sqlite3
+import json
+import threading
+import os
+import hashlib
+import yaml
+from tqdm import tqdm
+
+# use yaml.CSafeDumper / if available but don't crash if it isn't
+try:
+    yaml_dumper = yaml.CSafeDumper
+except (ImportError, AttributeError):
+    yaml_dumper = yaml.SafeDumper
+
+#
+# The detections are recorded in a sqlite database, one row per image as soon as
+# it has been processed, so that an interruption loses at most the current image.
+# The tables mirror the db.yml format:
+#
+# ws:   w                    (works that have been processed)
+# igs:  w, ig, n             (image groups with their volume number)
+# imgs: w, ig, fname, dets   (dets is the json list of detections)
+#
+# and the fingerprints of the image groups when they were scanned (see the delta
+# mode of create_db.py), which are not part of db.yml:
+#
+# ig_fps: w, ig, cat, etag    (intro pages in the catalog, ETag of dimensions.json)
+#
+
+class ScanStore:
+
+    def __init__(self, path="db.sqlite"):
+        self.path = path
+        # isolation_level=None means autocommit, each write is durable when the call returns
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS ws (w TEXT PRIMARY KEY)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS igs (w TEXT, ig TEXT, n INTEGER, PRIMARY KEY (w, ig))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS imgs (w TEXT, ig TEXT, fname TEXT, dets TEXT, PRIMARY KEY (w, ig, fname))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS ig_fps (w TEXT, ig TEXT, cat TEXT, etag TEXT, PRIMARY KEY (w, ig))")
+        # the connection is shared by the download threads
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM ws LIMIT 1").fetchone() is None
+
+    def add_w(self, w):
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO ws VALUES (?)", (w,))
+
+    def set_ig(self, w, ig, n):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO igs VALUES (?, ?, ?)", (w, ig, n))
+
+    def add_img(self, w, ig, fname, dets):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO imgs VALUES (?, ?, ?, ?)", (w, ig, fname, json.dumps(dets)))
+
+    def clear_ig(self, w, ig):
+        # removes the detections of an image group, before scanning it again
+        with self.lock:
+            self.conn.execute("DELETE FROM imgs WHERE w = ? AND ig = ?", (w, ig))
+
+    def set_ig_fingerprint(self, w, ig, cat, etag):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO ig_fps VALUES (?, ?, ?, ?)", (w, ig, cat, etag))
+
+    def get_ig_fingerprints(self):
+        # (w, ig) -> (cat, etag) for the image groups that have a fingerprint
+        with self.lock:
+            return {(w, ig): (cat, etag) for w, ig, cat, etag in self.conn.execute("SELECT w, ig, cat, etag FROM ig_fps")}
+
+    def get_ig_ns(self):
+        # (w, ig) -> volume number recorded for the image group
+        with self.lock:
+            return {(w, ig): n for w, ig, n in self.conn.execute("SELECT w, ig, n FROM igs")}
+
+    def get_w(self, w):
+        """
+        returns the information on the work in the db.yml format, or None if
+        the work has never been processed
+        """
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM ws WHERE w = ?", (w,)).fetchone() is None:
+                return None
+            igrows = self.conn.execute("SELECT ig, n FROM igs WHERE w = ?", (w,)).fetchall()
+            imgrows = self.conn.execute("SELECT ig, fname, dets FROM imgs WHERE w = ?", (w,)).fetchall()
+        res = {}
+        for ig, n in igrows:
+            res[ig] = {"n": n}
+        for ig, fname, dets in imgrows:
+            if ig not in res:
+                res[ig] = {}
+            res[ig][fname] = json.loads(dets)
+        return res
+
+    def iter_ws(self):
+        """
+        yields (w, w_info) in the order of the w, one work at a time
+        """
+        with self.lock:
+            ws = [row[0] for row in self.conn.execute("SELECT w FROM ws ORDER BY w")]
+        for w in ws:
+            yield w, self.get_w(w)
+
+    def get_fingerprints(self):
+        """
+        returns the (w, fingerprint) of all the works, in the order of the w, the
+        fingerprint changes when an image group or detection of the work changes
+        """
+        hashes = {}
+        with self.lock:
+            ws = [row[0] for row in self.conn.execute("SELECT w FROM ws ORDER BY w")]
+            for w, ig, n in self.conn.execute("SELECT w, ig, n FROM igs ORDER BY w, ig"):
+                hashes.setdefault(w, hashlib.sha1()).update(("%s\t%s\n" % (ig, n)).encode('utf-8'))
+            for w, ig, fname, dets in self.conn.execute("SELECT w, ig, fname, dets FROM imgs ORDER BY w, ig, fname"):
+                hashes.setdefault(w, hashlib.sha1()).update(("%s\t%s\t%s\n" % (ig, fname, dets)).encode('utf-8'))
+        return [(w, hashes[w].hexdigest() if w in hashes else "") for w in ws]
+
+    def import_db(self, works):
+        # works is an iterable of (w, w_info)
+        with self.lock:
+            self.conn.execute("BEGIN")
+            for w, w_info in works:
+                self.conn.execute("INSERT OR IGNORE INTO ws VALUES (?)", (w,))
+                for ig, ig_info in w_info.items():
+                    for fname, dets in ig_info.items():
+                        if fname == "n":
+                            self.conn.execute("INSERT OR REPLACE INTO igs VALUES (?, ?, ?)", (w, ig, dets))
+                        else:
+                            self.conn.execute("INSERT OR REPLACE INTO imgs VALUES (?, ?, ?, ?)", (w, ig, fname, json.dumps(dets)))
+            self.conn.execute("COMMIT")
+
+    def import_yaml(self, path="db.yml", keep=None):
+        # keep is an optional function telling which works to import
+        # imported here since db_stream itself imports this module
+        from db_stream import iter_works
+        self.import_db((w, w_info) for w, w_info in tqdm(iter_works(path)) if keep is None or keep(w))
+
+    def merge(self, path):
+        """
+        adds the content of another store (typically a shard), its rows
+        replace the ones of the same images
+        """
+        with self.lock:
+            self.conn.execute("ATTACH DATABASE ? AS other", (path,))
+            self.conn.execute("BEGIN")
+            self.conn.execute("INSERT OR IGNORE INTO ws SELECT * FROM other.ws")
+            self.conn.execute("INSERT OR REPLACE INTO igs SELECT * FROM other.igs")
+            self.conn.execute("INSERT OR REPLACE INTO imgs SELECT * FROM other.imgs")
+            self.conn.execute("INSERT OR REPLACE INTO ig_fps SELECT * FROM other.ig_fps")
+            self.conn.execute("COMMIT")
+            self.conn.execute("DETACH DATABASE other")
+
+    def export_yaml(self, path="db.yml"):
+        """
+        writes the store in the db.yml format, the works are dumped one by one
+        (yaml.dump sorts the keys so the result is the same as dumping the whole db)
+        and the file is replaced atomically at the end
+        """
+        tmppath = path+".tmp"
+        with open(tmppath, 'w') as stream:
+            for w, w_info in self.iter_ws():
+                yaml.dump({w: w_info}, stream, Dumper=yaml_dumper)
+        os.replace(tmppath, path)
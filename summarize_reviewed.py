@@ -1,8 +1,14 @@
 import csv
+import os
+import sys
 import yaml
 import re
+import argparse
 from tqdm import tqdm
-import pyisbn
+from identifiers import normalize_isbn, normalize_from_db, well_formed, guess_id_type
+from db_stream import iter_works
+import catalog
+from parallel import map_partitions, check_parallel
 
 # use yaml.CSafeLoader / if available but don't crash if it isn't
 try:
@@ -15,35 +21,6 @@ try:
 except (ImportError, AttributeError):
     yaml_dumper = yaml.SafeDumper
 
-def normalize_isbn(isbn):
-    return isbn.upper().replace("-", "").replace(" ", "")
-
-def well_formed(isbn):
-    # assumes isbn is normalized
-    match = re.search(r'^(\d{9}[0-9X]|\d{7}[0-9X]|\d{13})$', isbn)
-    return True if match else False
-
-def valid(isbn):
-    # assumes isbn is normalized
-    match = re.search(r'^(\d{9}|\d{12})(\d|X)$', isbn)
-    if not match:
-        return False
-
-    digits = match.group(1)
-    check_digit = 10 if match.group(2) == 'X' else int(match.group(2))
-    result = sum((i + 1) * int(digit) for i, digit in enumerate(digits))
-    if len(isbn) == 10:
-        return (result % 11) == check_digit
-    else:
-        return (result % 10) == check_digit
-
-def looksgood(isbn):
-    if not well_formed(isbn):
-        return False
-    if not isbn.startswith("978") and not isbn.startswith("979"):
-        return False
-    return pyisbn.validate(isbn)
-
 def comatible(num1, num2):
     if not num1 or not num2:
         return True
@@ -78,20 +55,6 @@ stats = {
 #      issn: [...]
 #      in: [...]
 
-def guess_id_type(num):
-    if len(num) == 8:
-        return "issn"
-    if len(num) == 2:
-        return "in"
-    if len(num) != 13:
-        # case of len(num) == 10 (most common) or anything weird
-        return "isbn"
-    if num.startswith("977"):
-        return "issn"
-    if num.startswith("978") or num.startswith("979"):
-        return "isbn"
-    return "ean"
-
 def keeps_all_compatible(num, nums):
     for n in nums:
         if not comatible(num, n):
@@ -130,12 +93,7 @@ def add_csv(reviewed_db, path, cols, multi, canhaveean=True):
 
 
 def get_w_to_mw():
-    res = {}
-    with open('mw-w-ig-vn.csv', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            res[row[1]] = row[0]
-    return res
+    return catalog.get_w_to_mw()
 
 # data["isbn_info"]
 #   isbn:
@@ -148,16 +106,10 @@ def get_w_to_mw():
 #     from_db: [isbns]
 #     from_scans: [isbns]
 
-def normalize_from_db(isbn):
-    if '(' in isbn:
-        isbn = isbn[:isbn.find('(')]
-    if '/' in isbn:
-        isbn = isbn[:isbn.find('/')]
-    return normalize_isbn(isbn)
-
-def analyze_w(w, w_dbinfo, mw, reviewed_db):
+def get_w_nums(w_dbinfo):
+    # (volnum, num) for each image of the work where a number was found, in order
+    res = []
     for ig, iginfo in w_dbinfo.items():
-        seen_isbns = []
         volnum = -1
         if "n" in iginfo:
             volnum = iginfo["n"]
@@ -168,7 +120,7 @@ def analyze_w(w, w_dbinfo, mw, reviewed_db):
             for det in detections:
                 if det["t"] != "EAN13":
                     continue
-                if (det["d"].startswith("977") or det["d"].startswith("978") or det["d"].startswith("979")) and well_formed(det["d"]):
+                if (det["d"].startswith("977") or det["d"].startswith("978") or det["d"].startswith("979")) and well_formed(det["d"], allow_issn=True):
                     num = det["d"]
                 else:
                     #print(det["d"]+" is malformed")
@@ -176,39 +128,54 @@ def analyze_w(w, w_dbinfo, mw, reviewed_db):
                         num = det["d"]
             if num is None:
                 continue
-            if mw not in reviewed_db:
-                #print("num for %s not in reviewed_db" % mw)
-                return
-            t = guess_id_type(num)
-            if num in reviewed_db[mw][t]:
-                continue
+            res.append((volnum, num))
+    return res
+
+def add_w_nums(mw, w_nums, reviewed_db):
+    if not w_nums:
+        return
+    if mw not in reviewed_db:
+        #print("num for %s not in reviewed_db" % mw)
+        return
+    for volnum, num in w_nums:
+        t = guess_id_type(num)
+        if num in reviewed_db[mw][t]:
+            continue
+        reviewed_db[mw][t].add(num)
+        if not reviewed_db[mw]["volume_nums_compatible"]:
             reviewed_db[mw][t].add(num)
-            if not reviewed_db[mw]["volume_nums_compatible"]:
-                reviewed_db[mw][t].add(num)
-                if volnum not in reviewed_db[mw]["volumes"]:
-                    reviewed_db[mw]["volumes"][volnum] = {"ean": set(), "isbn": set(), "issn": set(), "in": set()}
-                reviewed_db[mw]["volumes"][volnum][t].add(num)
+            if volnum not in reviewed_db[mw]["volumes"]:
+                reviewed_db[mw]["volumes"][volnum] = {"ean": set(), "isbn": set(), "issn": set(), "in": set()}
+            reviewed_db[mw]["volumes"][volnum][t].add(num)
+
+def nums_partition(partition):
+    # runs in the worker processes
+    return [get_w_nums(w_dbinfo) for w, mw, w_dbinfo in partition]
+
+def iter_w_jobs(db_path, w_to_mw):
+    for w, w_dbinfo in tqdm(iter_works(db_path)):
+        if w not in w_to_mw:
+            # weird case where some spurious ws are in the db with no data
+            continue
+        yield w, w_to_mw[w], w_dbinfo
 
 def get_mw_infos(data):
     # todo: handle cases like "8189165275, 9788189165277" which are isbn10, isbn13 of same isbn
-    with open('mw-isbn.csv', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            mw = row[0]
-            orig_isbn_str = row[1]
-            orig_isbns = re.split(',|;', orig_isbn_str)
-            normalized_isbns = []
-            for orig_isbn in orig_isbns:
-                normalized_isbn = normalize_from_db(orig_isbn)
-                if normalized_isbn:
-                    normalized_isbns.append(normalized_isbn)
-            if len(normalized_isbns) != 1 or normalized_isbns[0] != orig_isbn_str:
-                data[mw] = normalized_isbns
-
-def main():
-    db = None
-    with open("db.yml", 'r') as stream:
-        db = yaml.load(stream, Loader=yaml_loader)
+    for mw, orig_isbn_str in catalog.load_catalog().iter_isbn_rows():
+        orig_isbns = re.split(',|;', orig_isbn_str)
+        normalized_isbns = []
+        for orig_isbn in orig_isbns:
+            normalized_isbn = normalize_from_db(orig_isbn)
+            if normalized_isbn:
+                normalized_isbns.append(normalized_isbn)
+        if len(normalized_isbns) != 1 or normalized_isbns[0] != orig_isbn_str:
+            data[mw] = normalized_isbns
+
+def main(db_path="db.yml", nb_workers=1, out_dir="analysis"):
+    """
+    with nb_workers > 1 the numbers are extracted from the works in worker processes
+    and added to reviewed_db in the order of the db, as in the serial run
+    """
     w_to_mw = get_w_to_mw()
     existing_isbns = {}
     get_mw_infos(existing_isbns)
@@ -219,13 +186,8 @@ def main():
     add_csv(reviewed_db, "reviewed_files/ISBN review step 1 - new multi volumes ISBN (no review ).csv", [2, 3], True, True)
     add_csv(reviewed_db, "reviewed_files/ISBN review step 1 - multiple volumes (to review).csv", [3], True, True)
     print("reviewed_db has %s mws" % len(reviewed_db))
-    for w in tqdm(db):
-        w_dbinfo = db[w]
-        if w not in w_to_mw:
-            # weird case where some spurious ws are in the db with no data
-            continue
-        mw = w_to_mw[w]
-        analyze_w(w, w_dbinfo, mw, reviewed_db)
+    for (w, mw, _), w_nums in map_partitions(nums_partition, iter_w_jobs(db_path, w_to_mw), nb_workers):
+        add_w_nums(mw, w_nums, reviewed_db)
     for mw, mw_existing_isbns in existing_isbns.items():
         if mw not in reviewed_db:
             reviewed_db[mw] = {"ean": set(), "isbn": set(), "issn": set(), "volume_nums_compatible": True, "volumes": {}}
@@ -245,14 +207,25 @@ def main():
                 multivolumes_rows.append([mw, volnum, ",".join(volinfo["isbn"]), ",".join(volinfo["issn"]), ",".join(volinfo["ean"]), ",".join(volinfo["in"])])
                 #if volinfo["ean"]:
                 #    print(volinfo)
-    with open('analysis/reviewed_for_versions.csv', 'w', newline='') as csvfile:
+    with open(os.path.join(out_dir, 'reviewed_for_versions.csv'), 'w', newline='') as csvfile:
         writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
         for row in monovolumes_rows:
             writer.writerow(row)
-    with open('analysis/reviewed_for_outlines.csv', 'w', newline='') as csvfile:
+    with open(os.path.join(out_dir, 'reviewed_for_outlines.csv'), 'w', newline='') as csvfile:
         writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
         for row in multivolumes_rows:
             writer.writerow(row)
 
-main()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="summarizes the reviewed files and the isbns found in the scans, writes the results in analysis/")
+    parser.add_argument("--db", default="db.yml", help="db.yml or db.sqlite")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="number of processes reading the works (1 = serial mode)")
+    parser.add_argument("--rdf-dump", help="read the catalog from this local RDF dump instead of mw-w-ig-vn.csv and mw-isbn.csv (requires pyoxigraph)")
+    parser.add_argument("--check-parallel", action="store_true", help="run the summary serially and in parallel in temporary directories and check that the outputs are identical")
+    args = parser.parse_args()
+    if args.rdf_dump is not None:
+        catalog.use_dump(args.rdf_dump)
+    if args.check_parallel:
+        sys.exit(0 if check_parallel(main, max(args.workers, 2), args.db) else 1)
+    main(args.db, args.workers)
 #print(guess_id_type("9787040119916"))
\ No newline at end of file